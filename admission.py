@@ -0,0 +1,125 @@
+import collections
+import threading
+import time
+
+class Admission:
+    """Limits on the tracing sessions running at the same time, per traced
+    host, per relay and in total (0 for no limit).
+
+    A job takes one session per target, all of them or none. A job over the
+    limits is rejected with the estimated delay before a slot frees up, or
+    waits in a queue if requested: a queued job is admitted as soon as all
+    its sessions fit, even before older jobs waiting for other hosts.
+    """
+    def __init__(self, max_per_host=1, max_per_relay=0, max_sessions=0,
+            max_queue=100):
+        self.max_per_host = max_per_host
+        self.max_per_relay = max_per_relay
+        self.max_sessions = max_sessions
+        self.max_queue = max_queue
+        self.lock = threading.Lock()
+        # ("host", host), ("relay", relay) or ("all", "") -> sessions
+        self.sessions = {}
+        # key -> {jobid: [sessions, expected end of the job]}
+        self.holders = {}
+        # (jobid, keys, duration, item)
+        self.queue = collections.deque()
+        self.rejected = 0
+
+    def limit(self, key):
+        if key[0] == "host":
+            return self.max_per_host
+        if key[0] == "relay":
+            return self.max_per_relay
+        return self.max_sessions
+
+    def saturated(self, keys):
+        # the keys over their limit if the sessions were added, lock held
+        over = []
+        for (key, count) in collections.Counter(keys).items():
+            limit = self.limit(key)
+            if limit > 0 and self.sessions.get(key, 0) + count > limit:
+                over.append(key)
+        return over
+
+    def take(self, jobid, keys, duration):
+        end = time.time() + duration
+        for key in keys:
+            self.sessions[key] = self.sessions.get(key, 0) + 1
+            h = self.holders.setdefault(key, {}).setdefault(jobid, [0, end])
+            h[0] += 1
+
+    def retry_after(self, keys, default):
+        # seconds until the first of the jobs holding these keys is expected
+        # to end, lock held
+        now = time.time()
+        ends = [h[1] for key in keys for h in self.holders.get(key, {}).values()]
+        if not ends:
+            return default
+        return max(1, int(min(ends) - now + 0.5))
+
+    def admit(self, jobid, keys, duration, item=None, default_retry=5):
+        # returns ("admitted", 0, []), ("queued", 0, keys over the limit) if
+        # an item to queue was given, or ("rejected", seconds before
+        # retrying, keys over the limit)
+        with self.lock:
+            over = self.saturated(keys)
+            if not over:
+                self.take(jobid, keys, duration)
+                return ("admitted", 0, over)
+            if item is not None and len(self.queue) < self.max_queue:
+                self.queue.append((jobid, keys, duration, item))
+                return ("queued", 0, over)
+            self.rejected += 1
+            return ("rejected", self.retry_after(over, default_retry), over)
+
+    def check(self, keys, default_retry=5):
+        # ([], 0) if the sessions fit right now, otherwise the keys over the
+        # limit and the seconds before retrying, nothing is taken
+        with self.lock:
+            over = self.saturated(keys)
+            if not over:
+                return (over, 0)
+            self.rejected += 1
+            return (over, self.retry_after(over, default_retry))
+
+    def release(self, jobid, keys):
+        # returns the queued items admitted with the freed sessions
+        admitted = []
+        with self.lock:
+            for key in keys:
+                if self.sessions.get(key, 0) > 0:
+                    self.sessions[key] -= 1
+                h = self.holders.get(key, {}).get(jobid)
+                if h is not None:
+                    h[0] -= 1
+                    if h[0] <= 0:
+                        del self.holders[key][jobid]
+                if key in self.sessions.keys() and self.sessions[key] == 0:
+                    del self.sessions[key]
+                    self.holders.pop(key, None)
+            for q in list(self.queue):
+                (qjobid, qkeys, duration, item) = q
+                if not self.saturated(qkeys):
+                    self.take(qjobid, qkeys, duration)
+                    self.queue.remove(q)
+                    admitted.append(item)
+        return admitted
+
+    def cancel(self, jobid):
+        # drop a queued job, returns False if it is not queued
+        with self.lock:
+            for q in list(self.queue):
+                if q[0] == jobid:
+                    self.queue.remove(q)
+                    return True
+        return False
+
+    def stats(self):
+        s = {}
+        with self.lock:
+            s["sessions"] = self.sessions.get(("all", ""), 0)
+            s["hosts"] = len([k for k in self.sessions.keys() if k[0] == "host"])
+            s["queued"] = len(self.queue)
+            s["rejected"] = self.rejected
+        return s
@@ -1,7 +1,13 @@
 import sqlite3
 from tracevisor import *
+from registry_cache import registry_cache
 
 class AnalysesServers(Tracevisor):
+    # values of the fields missing when registering a analysis
+    DEFAULTS = {"ipv4": "", "ipv6": "", "sshport": 22, "sshuser": "root",
+            "maxjobs": 4}
+    RANGES = {"sshport": Tracevisor.PORT_RANGE, "maxjobs": (0, 1 << 31)}
+
     def __init__(self):
         pass
 
@@ -13,21 +19,37 @@ class AnalysesServers(Tracevisor):
         analysis["ipv6"] = rq[3]
         analysis["sshport"] = rq[4]
         analysis["sshuser"] = rq[5]
+        analysis["maxjobs"] = rq[6]
         return analysis
 
-    def get_analysis_list(self):
+    def analysis_address(self, analysis):
+        if analysis["ipv4"]:
+            return analysis["ipv4"]
+        elif analysis["ipv6"]:
+            return analysis["ipv6"]
+        return analysis["hostname"]
+
+    def get_servers(self):
+        # all the registered analysis servers, for the scheduler
+        entry = registry_cache.get("analyses", self.load_analyses)
+        if entry is not None:
+            return entry["rows"]
+        return self.load_analyses()
+
+    def load_analyses(self, limit=-1):
         analyses = []
-        resp = None
         self.connect_db()
         cur = self.con.cursor()
         with self.con:
-            cur.execute("SELECT * FROM analyses")
+            cur.execute("SELECT * FROM analyses ORDER BY id LIMIT :limit", {"limit": limit})
             r = cur.fetchall()
             for i in r:
                 analyses.append(self.rq_to_analysis(i))
-            resp = Response(json.dumps(analyses), mimetype="application/json")
         self.disconnect_db()
-        return resp
+        return analyses
+
+    def get_analysis_list(self):
+        return self.registry_listing("analyses", self.rq_to_analysis, self.load_analyses)
 
     def get_analysis(self, cur, hostname):
         cur.execute("SELECT * FROM analyses WHERE hostname=:hostname", {"hostname": hostname})
@@ -37,28 +59,23 @@ class AnalysesServers(Tracevisor):
         return None
 
     def get_analysis_id(self, analysis_id):
-        self.connect_db()
-        with self.con:
-            cur = self.con.cursor()
-            cur.execute("SELECT * FROM analyses WHERE id=:id", {"id": analysis_id})
-            rq = cur.fetchall()
-            if rq:
-                ret = Response(json.dumps(self.rq_to_analysis(rq[0])), mimetype="application/json")
-            else:
-                ret = "Unknown analysis ID %d\n" % analysis_id, 503
-        self.disconnect_db()
+        analysis = self.registry_get("analyses", self.rq_to_analysis, self.load_analyses, analysis_id)
+        if analysis is None:
+            return "Unknown analysis ID %d\n" % analysis_id, 503
+        return self.json_response(json.dumps(analysis))
+
+    def insert_analysis(self, cur, fields, update=()):
+        # create the analysis, or update the "update" fields of the existing one
+        # with the same hostname, returns its ID
+        return self.upsert(cur, "analyses", fields, update)
+
+    def bulk_analyses(self):
+        ret = self.bulk_import("analyses", self.DEFAULTS, self.RANGES)
+        registry_cache.invalidate("analyses")
         return ret
 
-    def insert_analysis(self, cur, fields):
-        ret = self.get_analysis(cur, fields["hostname"])
-        if ret:
-            return -1
-        cur.execute("INSERT INTO analyses VALUES(NULL,?,?,?,?,?)",
-                (fields["hostname"], fields["ipv4"], fields["ipv6"], fields["sshport"],
-                    fields["sshuser"]))
-        cur.execute("SELECT MAX(ID) FROM analyses WHERE hostname=:hostname", fields)
-        r = cur.fetchall()
-        return r[0][0]
+    def export_analyses(self):
+        return self.export_table("analyses", self.rq_to_analysis)
 
     def delete_analysis(self, analysis_id):
         self.connect_db()
@@ -66,6 +83,7 @@ class AnalysesServers(Tracevisor):
         with self.con:
             cur.execute("DELETE FROM analyses WHERE id=:id", {"id":analysis_id})
         self.disconnect_db()
+        registry_cache.invalidate("analyses")
         return "Done"
 
     def add_analysis(self):
@@ -78,19 +96,16 @@ class AnalysesServers(Tracevisor):
                 abort(400)
         if not "ipv4" in request.json and not "ipv6" in request.json:
             return "Missing IPv4 or IPv6 address\n", 400
+        bad = self.invalid_int(request.json, self.RANGES)
+        if bad is not None:
+            return "Invalid %s\n" % bad, 400
 
         self.connect_db()
         with self.con:
             cur = self.con.cursor()
             hostname = request.json["hostname"]
-            rq = self.get_analysis(cur, hostname)
-            if not rq:
-                rq = {}
-                rq["hostname"] = hostname
-                rq["ipv4"] = ""
-                rq["ipv6"] = ""
-                rq["sshport"] = 22
-                rq["sshuser"] = "root"
+            rq = dict(self.DEFAULTS)
+            rq["hostname"] = hostname
             if "ipv4" in request.json:
                 rq["ipv4"] = request.json["ipv4"]
             if "ipv6" in request.json:
@@ -99,16 +114,21 @@ class AnalysesServers(Tracevisor):
                 rq["sshport"] = request.json["sshport"]
             if "sshuser" in request.json:
                 rq["sshuser"] = request.json["sshuser"]
-            ret = self.insert_analysis(cur, rq)
-            if ret > 0:
-                ret = "%s/%d" % (request.url, ret)
-            else:
-                ret = "Relay %s already exists\n" % hostname, 503
+            if "maxjobs" in request.json:
+                rq["maxjobs"] = request.json["maxjobs"]
+            ret = self.insert_analysis(cur, rq, request.json.keys())
+            ret = "%s/%d" % (request.url, ret)
 
         self.disconnect_db()
+        registry_cache.invalidate("analyses")
         return ret
 
     def update_analysis(self, analysis_id):
+        if not request.json:
+            abort(400)
+        bad = self.invalid_int(request.json, self.RANGES)
+        if bad is not None:
+            return "Invalid %s\n" % bad, 400
         self.connect_db()
         cur = self.con.cursor()
         cur.execute("SELECT * FROM analyses WHERE id=:id", {"id": analysis_id})
@@ -130,9 +150,17 @@ class AnalysesServers(Tracevisor):
             analysis["sshuser"] = request.json["sshuser"]
         if "sshport" in request.json:
             analysis["sshport"] = request.json["sshport"]
+        if "maxjobs" in request.json:
+            analysis["maxjobs"] = request.json["maxjobs"]
 
-        cur.execute("UPDATE analyses SET hostname=:hostname, ipv4=:ipv4, ipv6=:ipv6,"
-                "sshuser=:sshuser, sshport=:sshport WHERE id=:id", (analysis))
+        try:
+            cur.execute("UPDATE analyses SET hostname=:hostname, ipv4=:ipv4, ipv6=:ipv6,"
+                    "sshuser=:sshuser, sshport=:sshport, maxjobs=:maxjobs WHERE id=:id",
+                    (analysis))
+        except sqlite3.IntegrityError:
+            self.disconnect_db()
+            return "Analysis %s already exists\n" % analysis["hostname"], 503
         self.con.commit()
+        registry_cache.invalidate("analyses")
         self.disconnect_db()
         return "%s" % (request.url)
@@ -0,0 +1,104 @@
+import collections
+
+class AnalysisScheduler:
+    """Dispatch of the analyses to the registered analysis servers.
+
+    The analyses wait in a FIFO queue and are dispatched, as soon as a slot
+    is free, to the server with the most free slots (then the fewest running
+    analyses). A server runs at most maxjobs analyses at a time, 0 for no
+    limit. The analyses with their own host, or submitted while no server is
+    registered, run on that host or on the relay, at most local_slots of
+    them at a time (0 for no limit). Everything runs on the job engine loop:
+    servers() returns the registered servers, run(item, server) is the
+    coroutine running an analysis, with None as server for the local ones.
+    """
+    def __init__(self, loop, servers, run, local_slots=8):
+        self.loop = loop
+        self.servers = servers
+        self.run = run
+        self.local_slots = local_slots
+        # (item, pinned to its own host)
+        self.queue = collections.deque()
+        # server ID -> number of running analyses
+        self.running = {}
+        self.local_running = 0
+        self.dispatched = 0
+
+    def submit(self, item, pinned=False):
+        self.queue.append((item, pinned))
+        try:
+            self.dispatch()
+        except Exception:
+            # not dispatched, the caller fails the analysis
+            for q in self.queue:
+                if q[0] is item:
+                    self.queue.remove(q)
+                    break
+            raise
+
+    def free_slots(self, server):
+        if not server["maxjobs"] or server["maxjobs"] <= 0:
+            return float("inf")
+        return server["maxjobs"] - self.running.get(server["id"], 0)
+
+    def local_full(self):
+        return self.local_slots > 0 and self.local_running >= self.local_slots
+
+    def pick(self, servers):
+        best = None
+        for s in servers:
+            free = self.free_slots(s)
+            if free <= 0:
+                continue
+            key = (-free, self.running.get(s["id"], 0))
+            if best is None or key < best[0]:
+                best = (key, s)
+        if best is None:
+            return None
+        return best[1]
+
+    def dispatch(self):
+        if not self.queue:
+            return
+        servers = self.servers()
+        servers_full = False
+        # in order, an analysis waiting for a full server does not hold the
+        # local ones back, and the other way around
+        for q in list(self.queue):
+            (item, pinned) = q
+            server = None
+            if servers and not pinned:
+                if servers_full:
+                    continue
+                server = self.pick(servers)
+                if server is None:
+                    servers_full = True
+                    continue
+                self.running[server["id"]] = self.running.get(server["id"], 0) + 1
+            else:
+                if self.local_full():
+                    if servers_full or not servers:
+                        break
+                    continue
+                self.local_running += 1
+            self.queue.remove(q)
+            self.dispatched += 1
+            self.loop.create_task(self.execute(item, server))
+
+    async def execute(self, item, server):
+        try:
+            await self.run(item, server)
+        finally:
+            if server is not None:
+                self.running[server["id"]] -= 1
+            else:
+                self.local_running -= 1
+            self.dispatch()
+
+    def stats(self):
+        s = {}
+        s["queued"] = len(self.queue)
+        s["dispatched"] = self.dispatched
+        s["running"] = dict(self.running)
+        s["local_running"] = self.local_running
+        return s
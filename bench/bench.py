@@ -0,0 +1,422 @@
+#!/usr/bin/env python3
+# Benchmark of the controller, with local stand-ins for ssh, lttng and the
+# analyses (see fake.py): runs a controller, submits jobs from concurrent
+# clients while other clients exercise the registry, and prints the results
+# as JSON. With --baseline, exits with status 1 if the results regressed by
+# more than --tolerance compared to a previous run.
+#
+#   $ bench/bench.py --jobs 200 --concurrency 16 --output bench.json
+#   $ bench/bench.py --jobs 200 --concurrency 16 --baseline bench.json
+
+import argparse
+import collections
+import http.client
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+FAKES = ["ssh", "lttng", "python3", "hostname", "pgrep", "groups", "du",
+        "avahi-browse"]
+
+def percentile(values, p):
+    # nearest rank
+    if not values:
+        return None
+    values = sorted(values)
+    i = max(0, min(len(values) - 1, int(round(p / 100.0 * len(values) + 0.5)) - 1))
+    return values[i]
+
+def distribution(values):
+    d = {}
+    d["count"] = len(values)
+    if values:
+        d["mean"] = round(sum(values) / len(values), 4)
+        d["p50"] = round(percentile(values, 50), 4)
+        d["p99"] = round(percentile(values, 99), 4)
+        d["max"] = round(max(values), 4)
+    return d
+
+class Client:
+    """HTTP client of the controller, recording the latency of each request
+    per endpoint (method and route, without the IDs).
+    """
+    def __init__(self, port):
+        self.port = port
+        self.lock = threading.Lock()
+        self.latencies = collections.defaultdict(list)
+        self.errors = collections.Counter()
+        self.local = threading.local()
+
+    def connection(self):
+        con = getattr(self.local, "con", None)
+        if con is None:
+            con = http.client.HTTPConnection("127.0.0.1", self.port, timeout=60)
+            self.local.con = con
+        return con
+
+    def request(self, method, path, body=None):
+        endpoint = "%s %s" % (method, re.sub("/[0-9]+", "/<id>", path.split("?")[0]))
+        headers = {}
+        if body is not None:
+            body = json.dumps(body)
+            headers["Content-Type"] = "application/json"
+        start = time.time()
+        try:
+            con = self.connection()
+            con.request(method, path, body, headers)
+            resp = con.getresponse()
+            data = resp.read()
+            status = resp.status
+        except (OSError, http.client.HTTPException):
+            self.local.con = None
+            (status, data) = (0, b"")
+        elapsed = time.time() - start
+        self.lock.acquire()
+        self.latencies[endpoint].append(elapsed)
+        if status != 200:
+            self.errors[endpoint] += 1
+        self.lock.release()
+        return (status, str(data, encoding="utf8"))
+
+    def stats(self):
+        s = {}
+        for endpoint in sorted(self.latencies.keys()):
+            s[endpoint] = distribution(self.latencies[endpoint])
+            s[endpoint]["errors"] = self.errors[endpoint]
+        return s
+
+class JobWatcher:
+    """Follow the jobs on the event stream: time of the start of the
+    tracing and of the end of each job.
+    """
+    def __init__(self, port, cursor):
+        self.port = port
+        self.cursor = cursor
+        self.cond = threading.Condition()
+        self.tracing = {}
+        self.finished = {}
+
+    def start(self):
+        t = threading.Thread(target=self.run)
+        t.daemon = True
+        t.start()
+
+    def run(self):
+        con = http.client.HTTPConnection("127.0.0.1", self.port)
+        con.request("GET", "/trace/api/v1.0/events?cursor=%d" % self.cursor)
+        resp = con.getresponse()
+        event = None
+        for line in resp:
+            line = str(line, encoding="utf8").rstrip("\n")
+            if line.startswith("event: "):
+                event = line[7:]
+            elif line.startswith("data: ") and event == "job":
+                self.update(json.loads(line[6:]))
+
+    def update(self, job):
+        now = time.time()
+        self.cond.acquire()
+        if job["status"] in ["tracing", "analysing"]:
+            self.tracing.setdefault(job["jobid"], now)
+        elif job["status"] in ["done", "error"]:
+            self.finished.setdefault(job["jobid"], (now, job["status"]))
+            self.cond.notify_all()
+        self.cond.release()
+
+    def wait(self, jobids, timeout):
+        deadline = time.time() + timeout
+        self.cond.acquire()
+        while [j for j in jobids if not j in self.finished] and time.time() < deadline:
+            self.cond.wait(deadline - time.time())
+        self.cond.release()
+
+class Sampler:
+    """Peak threads and resident memory of the controller, from /proc."""
+    def __init__(self, pid, interval=0.1):
+        self.pid = pid
+        self.interval = interval
+        self.peak_threads = 0
+        self.peak_rss_kb = 0
+        self.rss_kb = 0
+        self.stopped = threading.Event()
+
+    def start(self):
+        t = threading.Thread(target=self.run)
+        t.daemon = True
+        t.start()
+
+    def sample(self):
+        with open("/proc/%d/status" % self.pid) as f:
+            for line in f:
+                (k, v) = line.split(":", 1)
+                if k == "Threads":
+                    self.peak_threads = max(self.peak_threads, int(v))
+                elif k == "VmRSS":
+                    self.rss_kb = int(v.split()[0])
+                elif k == "VmHWM":
+                    self.peak_rss_kb = max(self.peak_rss_kb, int(v.split()[0]))
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.sample()
+            except (OSError, ValueError):
+                return
+
+def free_port():
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def make_fakes(tmp):
+    # the wrappers run fake.py with this interpreter, "python3" is one of
+    # the fakes
+    fakes = os.path.join(tmp, "bin")
+    os.mkdir(fakes)
+    for name in FAKES:
+        path = os.path.join(fakes, name)
+        with open(path, "w") as f:
+            f.write("#!/bin/sh\nexec %s %s %s \"$@\"\n" % (sys.executable,
+                os.path.join(BENCH_DIR, "fake.py"), name))
+        os.chmod(path, 0o755)
+    return fakes
+
+def start_controller(args, tmp, port):
+    fakes = make_fakes(tmp)
+    env = dict(os.environ)
+    env["PATH"] = "%s:%s" % (fakes, env["PATH"])
+    # the ssh multiplexing sockets go in HOME
+    env["HOME"] = tmp
+    env["BENCH_CONNECT_LATENCY"] = str(args.connect_latency)
+    env["BENCH_RTT"] = str(args.rtt)
+    env["BENCH_CONNECT_FAILURE_RATE"] = str(args.connect_failure_rate)
+    env["BENCH_LTTNG_LATENCY"] = str(args.lttng_latency)
+    env["BENCH_ANALYSIS_LATENCY"] = str(args.analysis_latency)
+    env["BENCH_FAILURE_RATE"] = str(args.failure_rate)
+    log = open(os.path.join(tmp, "controller.log"), "w")
+    proc = subprocess.Popen([sys.executable, os.path.join(BENCH_DIR, "controller.py"),
+        "%s -oBatchMode=yes" % os.path.join(fakes, "ssh"), str(port)],
+        cwd=tmp, env=env, stdout=log, stderr=subprocess.STDOUT,
+        start_new_session=True)
+    return proc
+
+def wait_ready(client, proc, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            return False
+        try:
+            con = http.client.HTTPConnection("127.0.0.1", client.port, timeout=1)
+            con.request("GET", "/")
+            if con.getresponse().status == 200:
+                return True
+        except OSError:
+            pass
+        time.sleep(0.1)
+    return False
+
+def submit_job(client, args, i, submitted):
+    hosts = ["bench-host-%d" % ((i * args.hosts + k) % args.host_pool)
+            for k in range(args.hosts)]
+    start = time.time()
+    (status, data) = client.request("POST", "/trace/api/v1.0/analyses",
+            {"hosts": hosts, "type": args.type, "duration": args.duration,
+                "username": "root", "queue": True})
+    m = re.search("jobid = ([0-9]+)", data)
+    if status == 200 and m:
+        submitted[int(m.group(1))] = start
+        client.request("GET", "/trace/api/v1.0/jobs/%s" % m.group(1))
+
+def crud_worker(client, w, stop):
+    # registry traffic: register, read, update and delete clients, list the
+    # registries and the jobs
+    n = 0
+    while not stop.is_set():
+        n += 1
+        hostname = "bench-client-%d-%d" % (w, n)
+        (status, data) = client.request("POST", "/trace/api/v1.0/clients",
+                {"hostname": hostname, "ipv4": "10.%d.%d.%d" % (w % 256, n // 256 % 256, n % 256)})
+        client.request("GET", "/trace/api/v1.0/clients")
+        client.request("GET", "/trace/api/v1.0/relays")
+        client.request("GET", "/trace/api/v1.0/list")
+        if status != 200:
+            continue
+        path = "/trace/api/v1.0/clients/%s" % data.split("/")[-1]
+        client.request("GET", path)
+        client.request("PUT", path, {"hostname": hostname, "ipv4": "10.255.0.1"})
+        if random.random() < 0.5:
+            client.request("DELETE", path)
+
+def run(args):
+    tmp = tempfile.mkdtemp(prefix="tracevisor-bench-")
+    port = args.port or free_port()
+    proc = start_controller(args, tmp, port)
+    client = Client(port)
+    try:
+        if not wait_ready(client, proc):
+            sys.stderr.write("The controller did not start, see %s/controller.log\n" % tmp)
+            args.keep = True
+            return None
+        sampler = Sampler(proc.pid)
+        sampler.start()
+        (status, data) = client.request("GET", "/trace/api/v1.0/list")
+        watcher = JobWatcher(port, json.loads(data)["cursor"])
+        watcher.start()
+
+        stop = threading.Event()
+        crud = [threading.Thread(target=crud_worker, args=(client, w, stop))
+                for w in range(args.crud_workers)]
+        for t in crud:
+            t.start()
+
+        # the jobs are submitted by args.concurrency clients
+        submitted = {}
+        counter = iter(range(args.jobs))
+        counter_lock = threading.Lock()
+        def submitter():
+            while True:
+                counter_lock.acquire()
+                i = next(counter, None)
+                counter_lock.release()
+                if i is None:
+                    return
+                submit_job(client, args, i, submitted)
+        start = time.time()
+        submitters = [threading.Thread(target=submitter) for i in range(args.concurrency)]
+        for t in submitters:
+            t.start()
+        for t in submitters:
+            t.join()
+        watcher.wait(list(submitted.keys()), args.timeout)
+        end = time.time()
+        stop.set()
+        for t in crud:
+            t.join()
+        sampler.stopped.set()
+    finally:
+        os.killpg(proc.pid, signal.SIGTERM)
+        proc.wait()
+        if not args.keep:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    finished = [watcher.finished[j] for j in submitted if j in watcher.finished]
+    last = max([f[0] for f in finished]) if finished else end
+    r = {}
+    r["config"] = dict(vars(args))
+    del r["config"]["output"], r["config"]["baseline"], r["config"]["keep"]
+    r["python"] = platform.python_version()
+    r["jobs"] = {}
+    r["jobs"]["requested"] = args.jobs
+    r["jobs"]["submitted"] = len(submitted)
+    r["jobs"]["done"] = len([f for f in finished if f[1] == "done"])
+    r["jobs"]["error"] = len([f for f in finished if f[1] == "error"])
+    r["jobs"]["unfinished"] = len(submitted) - len(finished)
+    r["jobs"]["seconds"] = round(last - start, 3)
+    r["jobs"]["per_second"] = round(len(finished) / (last - start), 3) \
+            if last > start else 0
+    r["jobs"]["start_latency"] = distribution([watcher.tracing[j] - submitted[j]
+        for j in submitted if j in watcher.tracing])
+    r["endpoints"] = client.stats()
+    r["controller"] = {}
+    r["controller"]["peak_threads"] = sampler.peak_threads
+    r["controller"]["peak_rss_kb"] = sampler.peak_rss_kb
+    r["controller"]["rss_kb"] = sampler.rss_kb
+    return r
+
+def regressions(result, baseline, tolerance):
+    # lower is better, except for the throughput
+    r = []
+    def check(name, new, old, higher_is_better=False):
+        if new is None or old is None or old == 0:
+            return
+        change = (new - old) / old
+        if higher_is_better:
+            change = -change
+        if change > tolerance:
+            r.append("%s: %s -> %s" % (name, old, new))
+    check("jobs/s", result["jobs"]["per_second"], baseline["jobs"]["per_second"], True)
+    check("start latency p99", result["jobs"]["start_latency"].get("p99"),
+            baseline["jobs"]["start_latency"].get("p99"))
+    for (endpoint, s) in result["endpoints"].items():
+        if endpoint in baseline["endpoints"].keys():
+            check("%s p99" % endpoint, s.get("p99"),
+                    baseline["endpoints"][endpoint].get("p99"))
+    check("peak threads", result["controller"]["peak_threads"],
+            baseline["controller"]["peak_threads"])
+    check("peak RSS", result["controller"]["peak_rss_kb"],
+            baseline["controller"]["peak_rss_kb"])
+    return r
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the tracevisor controller")
+    parser.add_argument("--jobs", type=int, default=50, help="number of jobs")
+    parser.add_argument("--concurrency", type=int, default=8,
+            help="clients submitting the jobs")
+    parser.add_argument("--hosts", type=int, default=2, help="hosts per job")
+    parser.add_argument("--host-pool", type=int, default=64,
+            help="distinct hosts traced")
+    parser.add_argument("--type", default="io", help="analysis type")
+    parser.add_argument("--duration", type=int, default=1,
+            help="tracing window of the jobs, in seconds")
+    parser.add_argument("--crud-workers", type=int, default=2,
+            help="clients exercising the registry during the benchmark")
+    parser.add_argument("--rtt", type=float, default=0.005,
+            help="ssh round-trip, in seconds")
+    parser.add_argument("--connect-latency", type=float, default=0.05,
+            help="new ssh connection, in seconds")
+    parser.add_argument("--lttng-latency", type=float, default=0.01,
+            help="each lttng command, in seconds")
+    parser.add_argument("--analysis-latency", type=float, default=0.5,
+            help="each analysis, in seconds")
+    parser.add_argument("--failure-rate", type=float, default=0,
+            help="failure rate of the lttng commands and analyses")
+    parser.add_argument("--connect-failure-rate", type=float, default=0,
+            help="failure rate of the ssh connections")
+    parser.add_argument("--timeout", type=float, default=300,
+            help="maximum wait for the jobs to finish, in seconds")
+    parser.add_argument("--port", type=int, default=0,
+            help="port of the controller, a free one by default")
+    parser.add_argument("--seed", type=int, default=0,
+            help="seed of the client side choices")
+    parser.add_argument("--output", help="write the results to this file")
+    parser.add_argument("--baseline", help="results of a previous run to compare to")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+            help="relative regression tolerated against the baseline")
+    parser.add_argument("--keep", action="store_true",
+            help="keep the controller directory (database and log)")
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    result = run(args)
+    if result is None:
+        sys.exit(2)
+    out = json.dumps(result, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(out + "\n")
+    else:
+        print(out)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        r = regressions(result, baseline, args.tolerance)
+        for line in r:
+            sys.stderr.write("Regression: %s\n" % line)
+        if r:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,27 @@
+#!/usr/bin/env python3
+# Run the controller for the benchmark, as tracevisor.py would, but with the
+# fake ssh command, on the given port and without the reloader. The
+# database is created in the current directory.
+# Usage: controller.py <ssh command> <port>
+
+import importlib.util
+import os
+import sys
+
+path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        "tracevisor.py")
+sys.path.insert(0, os.path.dirname(path))
+
+if __name__ == "__main__":
+    # loaded under another name than __main__, the same way as when it is run
+    spec = importlib.util.spec_from_file_location("tracevisor_main", path)
+    main = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(main)
+
+    t = main.Tracevisor()
+    t.ssh = sys.argv[1]
+    t.sshpool = main.SSHPool(t.ssh, t.ssh_idle_timeout)
+    main.tracevisor = t
+    t.check_db()
+    t.jobstore.recover()
+    main.app.run(host="127.0.0.1", port=int(sys.argv[2]), threaded=True)
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# Stand-ins for ssh and the commands run on the traced hosts, for the
+# benchmark. Called as "fake.py <command> <args>" by the wrappers that
+# bench.py puts first in the PATH. The latencies (in seconds) and the
+# failure rates come from the environment:
+#   BENCH_CONNECT_LATENCY       new ssh connection (no master socket yet)
+#   BENCH_RTT                   ssh round-trip of each command
+#   BENCH_CONNECT_FAILURE_RATE  ssh connection failures (exit status 255)
+#   BENCH_LTTNG_LATENCY         each lttng command
+#   BENCH_ANALYSIS_LATENCY      the analysis script
+#   BENCH_FAILURE_RATE          failures of the lttng commands and analyses
+
+import os
+import random
+import sys
+import time
+
+def setting(name, default):
+    return float(os.environ.get(name, default))
+
+def fail(rate_name):
+    return random.random() < setting(rate_name, 0)
+
+def ssh(args):
+    # skip the options up to user@host, the rest is the remote command
+    control_path = None
+    control_cmd = None
+    i = 0
+    while i < len(args):
+        a = args[i]
+        if a in ["-p", "-i", "-o", "-O"]:
+            if a == "-O":
+                control_cmd = args[i + 1]
+            elif args[i + 1].startswith("ControlPath="):
+                control_path = args[i + 1].split("=", 1)[1]
+            i += 2
+            continue
+        if a.startswith("-oControlPath="):
+            control_path = a.split("=", 1)[1]
+        if not a.startswith("-"):
+            break
+        i += 1
+    host = args[i].split("@")[-1]
+    cmd = " ".join(args[i + 1:])
+
+    if control_cmd is not None:
+        if control_cmd in ["exit", "stop"] and control_path is not None and \
+                os.path.exists(control_path):
+            os.unlink(control_path)
+        return 0
+    # only the first command to a host pays for the connection
+    if control_path is None or not os.path.exists(control_path):
+        time.sleep(setting("BENCH_CONNECT_LATENCY", 0.05))
+        if fail("BENCH_CONNECT_FAILURE_RATE"):
+            sys.stderr.write("ssh: connect to host %s: Connection refused\n" % host)
+            return 255
+        if control_path is not None:
+            open(control_path, "w").close()
+    time.sleep(setting("BENCH_RTT", 0.005))
+    env = dict(os.environ)
+    env["BENCH_HOST"] = host
+    os.execvpe("bash", ["bash", "-c", cmd], env)
+
+def lttng(args):
+    time.sleep(setting("BENCH_LTTNG_LATENCY", 0.01))
+    if fail("BENCH_FAILURE_RATE"):
+        sys.stderr.write("Error: lttng %s failed\n" % " ".join(args))
+        return 1
+    return 0
+
+def analysis(args):
+    time.sleep(setting("BENCH_ANALYSIS_LATENCY", 0.5))
+    if fail("BENCH_FAILURE_RATE"):
+        return 1
+    print("Analysis done")
+    return 0
+
+def hostname(args):
+    print(os.environ.get("BENCH_HOST", "localhost").split(".")[0])
+    return 0
+
+def pgrep(args):
+    print(1)
+    return 0
+
+def groups(args):
+    print("root tracing")
+    return 0
+
+def du(args):
+    print("0\ttotal")
+    return 0
+
+def avahi_browse(args):
+    # nothing announced, and never exits
+    while True:
+        time.sleep(3600)
+
+commands = {
+    "ssh": ssh,
+    "lttng": lttng,
+    "python3": analysis,
+    "hostname": hostname,
+    "pgrep": pgrep,
+    "groups": groups,
+    "du": du,
+    "avahi-browse": avahi_browse,
+}
+
+if __name__ == "__main__":
+    sys.exit(commands[sys.argv[1]](sys.argv[2:]))
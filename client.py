@@ -1,9 +1,21 @@
 import sqlite3
 from tracevisor import *
+from registry_cache import registry_cache
 
 class Client(Tracevisor):
-    def __init__(self):
-        pass
+    # values of the fields missing when registering a client
+    DEFAULTS = {"ipv4": "", "ipv6": "", "sshport": 22, "sshuser": "root", "groupname": ""}
+    RANGES = {"sshport": Tracevisor.PORT_RANGE}
+
+    def __init__(self, requirements_cache=None):
+        self.requirements_cache = requirements_cache
+
+    def invalidate_requirements(self, client):
+        # the preflight checks may be cached under any address of the client
+        if self.requirements_cache is None:
+            return
+        self.requirements_cache.invalidate_host([client["hostname"],
+            client["ipv4"], client["ipv6"]])
 
     def rq_to_client(self, rq):
         client = {}
@@ -13,21 +25,42 @@ class Client(Tracevisor):
         client["ipv6"] = rq[3]
         client["sshport"] = rq[4]
         client["sshuser"] = rq[5]
+        client["groupname"] = rq[6]
         return client
 
-    def get_clients_list(self):
+    def load_clients(self, limit=-1):
         clients = []
-        resp = None
         self.connect_db()
         cur = self.con.cursor()
         with self.con:
-            cur.execute("SELECT * FROM clients")
+            cur.execute("SELECT * FROM clients ORDER BY id LIMIT :limit", {"limit": limit})
             r = cur.fetchall()
             for i in r:
                 clients.append(self.rq_to_client(i))
         self.disconnect_db()
         return clients
 
+    def get_clients_list(self, extra=None):
+        return self.registry_listing("clients", self.rq_to_client,
+                self.load_clients, extra)
+
+    def get_group_clients(self, groupname):
+        clients = []
+        entry = registry_cache.get("clients", self.load_clients)
+        if entry is not None:
+            for c in entry["rows"]:
+                if c["groupname"] == groupname:
+                    clients.append(c)
+            return clients
+        self.connect_db()
+        cur = self.con.cursor()
+        cur.execute("SELECT * FROM clients WHERE groupname=:groupname",
+                {"groupname": groupname})
+        for i in cur.fetchall():
+            clients.append(self.rq_to_client(i))
+        self.disconnect_db()
+        return clients
+
     def get_client(self, cur, hostname):
         cur.execute("SELECT * FROM clients WHERE hostname=:hostname", {"hostname": hostname})
         rq = cur.fetchall()
@@ -36,35 +69,38 @@ class Client(Tracevisor):
         return None
 
     def get_client_id(self, client_id):
-        self.connect_db()
-        with self.con:
-            cur = self.con.cursor()
-            cur.execute("SELECT * FROM clients WHERE id=:id", {"id": client_id})
-            rq = cur.fetchall()
-            if rq:
-                ret = Response(json.dumps(self.rq_to_client(rq[0])), mimetype="application/json")
-            else:
-                ret = "Unknown client ID %d\n" % client_id, 503
-        self.disconnect_db()
+        client = self.registry_get("clients", self.rq_to_client, self.load_clients, client_id)
+        if client is None:
+            return "Unknown client ID %d\n" % client_id, 503
+        return self.json_response(json.dumps(client))
+
+    def insert_client(self, cur, fields, update=()):
+        # create the client, or update the "update" fields of the existing one
+        # with the same hostname, returns its ID
+        return self.upsert(cur, "clients", fields, update)
+
+    def bulk_clients(self):
+        ret = self.bulk_import("clients", self.DEFAULTS, self.RANGES)
+        registry_cache.invalidate("clients")
+        # any of the clients may have changed
+        if self.requirements_cache is not None:
+            self.requirements_cache.clear()
         return ret
 
-    def insert_client(self, cur, fields):
-        ret = self.get_client(cur, fields["hostname"])
-        if ret:
-            return -1
-        cur.execute("INSERT INTO clients VALUES(NULL,?,?,?,?,?)",
-                (fields["hostname"], fields["ipv4"], fields["ipv6"], fields["sshport"],
-                    fields["sshuser"]))
-        cur.execute("SELECT MAX(ID) FROM clients WHERE hostname=:hostname", fields)
-        r = cur.fetchall()
-        return r[0][0]
+    def export_clients(self):
+        return self.export_table("clients", self.rq_to_client)
 
     def delete_client(self, client_id):
         self.connect_db()
         cur = self.con.cursor()
         with self.con:
+            cur.execute("SELECT * FROM clients WHERE id=:id", {"id": client_id})
+            rq = cur.fetchall()
+            if rq:
+                self.invalidate_requirements(self.rq_to_client(rq[0]))
             cur.execute("DELETE FROM clients WHERE id=:id", {"id":client_id})
         self.disconnect_db()
+        registry_cache.invalidate("clients")
         return "Done"
 
     def add_client(self):
@@ -77,19 +113,16 @@ class Client(Tracevisor):
                 abort(400)
         if not "ipv4" in request.json and not "ipv6" in request.json:
             return "Missing IPv4 or IPv6 address\n", 400
+        bad = self.invalid_int(request.json, self.RANGES)
+        if bad is not None:
+            return "Invalid %s\n" % bad, 400
 
         self.connect_db()
         with self.con:
             cur = self.con.cursor()
             hostname = request.json["hostname"]
-            rq = self.get_client(cur, hostname)
-            if not rq:
-                rq = {}
-                rq["hostname"] = hostname
-                rq["ipv4"] = ""
-                rq["ipv6"] = ""
-                rq["sshport"] = 22
-                rq["sshuser"] = "root"
+            rq = dict(self.DEFAULTS)
+            rq["hostname"] = hostname
             if "ipv4" in request.json:
                 rq["ipv4"] = request.json["ipv4"]
             if "ipv6" in request.json:
@@ -98,16 +131,23 @@ class Client(Tracevisor):
                 rq["sshport"] = request.json["sshport"]
             if "sshuser" in request.json:
                 rq["sshuser"] = request.json["sshuser"]
-            ret = self.insert_client(cur, rq)
-            if ret > 0:
-                ret = "%s/%d" % (request.url, ret)
-            else:
-                ret = "Relay %s already exists\n" % hostname, 503
+            if "groupname" in request.json:
+                rq["groupname"] = request.json["groupname"]
+            ret = self.insert_client(cur, rq, request.json.keys())
+            # the client may already exist and have changed
+            self.invalidate_requirements(rq)
+            ret = "%s/%d" % (request.url, ret)
 
         self.disconnect_db()
+        registry_cache.invalidate("clients")
         return ret
 
     def update_client(self, client_id):
+        if not request.json:
+            abort(400)
+        bad = self.invalid_int(request.json, self.RANGES)
+        if bad is not None:
+            return "Invalid %s\n" % bad, 400
         self.connect_db()
         cur = self.con.cursor()
         cur.execute("SELECT * FROM clients WHERE id=:id", {"id": client_id})
@@ -119,6 +159,7 @@ class Client(Tracevisor):
             return self.add_client()
 
         client = self.rq_to_client(rq[0])
+        self.invalidate_requirements(client)
         if "hostname" in request.json:
             client["hostname"] = request.json["hostname"]
         if "ipv4" in request.json:
@@ -129,9 +170,18 @@ class Client(Tracevisor):
             client["sshuser"] = request.json["sshuser"]
         if "sshport" in request.json:
             client["sshport"] = request.json["sshport"]
+        if "groupname" in request.json:
+            client["groupname"] = request.json["groupname"]
 
-        cur.execute("UPDATE clients SET hostname=:hostname, ipv4=:ipv4, ipv6=:ipv6,"
-                "sshuser=:sshuser, sshport=:sshport WHERE id=:id", (client))
+        try:
+            cur.execute("UPDATE clients SET hostname=:hostname, ipv4=:ipv4, ipv6=:ipv6,"
+                    "sshuser=:sshuser, sshport=:sshport, groupname=:groupname WHERE id=:id",
+                    (client))
+        except sqlite3.IntegrityError:
+            self.disconnect_db()
+            return "Client %s already exists\n" % client["hostname"], 503
         self.con.commit()
+        registry_cache.invalidate("clients")
+        self.invalidate_requirements(client)
         self.disconnect_db()
         return "%s" % (request.url)
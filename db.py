@@ -0,0 +1,81 @@
+import contextlib
+import queue
+import sqlite3
+import threading
+
+class Database:
+    """Pool of persistent connections to the configuration database.
+
+    A request takes a connection from the pool in connect_db and gives it
+    back in disconnect_db, so the connections outlive the threads of the
+    server (one per client connection). Up to pool_size idle connections are
+    kept, a request finding the pool empty opens a new one. A thread using
+    the database outside of a request keeps its connection.
+
+    The database is in WAL mode so the readers do not block the writer, and
+    a writer waits up to busy_timeout seconds for the lock instead of failing
+    with "database is locked". Each connection keeps a cache of prepared
+    statements.
+    """
+    def __init__(self, path, busy_timeout=10.0, cached_statements=256,
+            pool_size=8):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self.cached_statements = cached_statements
+        self.pool = queue.LifoQueue(maxsize=pool_size)
+        self.local = threading.local()
+
+    def open(self):
+        # used by one thread at a time, but not always the same one
+        con = sqlite3.connect(self.path, timeout=self.busy_timeout,
+                cached_statements=self.cached_statements,
+                check_same_thread=False)
+        con.execute("PRAGMA journal_mode=WAL")
+        # durable at each checkpoint, enough for this data in WAL mode
+        con.execute("PRAGMA synchronous=NORMAL")
+        return con
+
+    def connection(self):
+        # connection of the current thread, taken from the pool if needed
+        con = getattr(self.local, "con", None)
+        if con is None:
+            try:
+                con = self.pool.get_nowait()
+            except queue.Empty:
+                con = self.open()
+            self.local.con = con
+            self.local.depth = 0
+        return con
+
+    def acquire(self):
+        con = self.connection()
+        self.local.depth += 1
+        return con
+
+    def release(self):
+        # end of a request: like closing the connection used to, drop what
+        # was not committed, and give the connection back to the pool
+        con = getattr(self.local, "con", None)
+        if con is None:
+            return
+        self.local.depth -= 1
+        if self.local.depth > 0:
+            return
+        self.local.con = None
+        if con.in_transaction:
+            con.rollback()
+        try:
+            self.pool.put_nowait(con)
+        except queue.Full:
+            con.close()
+
+    @contextlib.contextmanager
+    def pooled(self):
+        # connection for a block of code, back to the pool at the end
+        con = self.acquire()
+        try:
+            yield con
+        finally:
+            self.release()
+
+database = Database("config.db")
@@ -0,0 +1,90 @@
+import subprocess
+import threading
+import time
+
+class Discovery:
+    """Hosts announcing the _lttng._tcp DNS-SD service, kept in memory.
+
+    A long-running avahi-browse (without -t, so it never terminates) reports
+    the services as they appear ("=" lines, once resolved) and disappear
+    ("-" lines). If it exits, it is restarted after a growing delay, and the
+    hosts not announced again within expire seconds after the restart are
+    dropped, their removal may have been missed in the meantime.
+    """
+    def __init__(self, command="avahi-browse _lttng._tcp -p -r", expire=30,
+            max_backoff=60):
+        self.command = command
+        self.expire = expire
+        self.max_backoff = max_backoff
+        self.lock = threading.Lock()
+        # (interface, protocol, name) -> (last seen, entry)
+        self.services = {}
+        self.restarted = 0
+        self.restarts = 0
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(name="discovery", target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        backoff = 1
+        while True:
+            started = time.time()
+            self.lock.acquire()
+            self.restarted = started
+            self.lock.release()
+            try:
+                p = subprocess.Popen(self.command.split(), stdout=subprocess.PIPE)
+                for line in p.stdout:
+                    self.parse(str(line, encoding='utf8').strip())
+                p.wait()
+                print("%s exited with status %d" % (self.command, p.returncode))
+            except OSError as e:
+                print("Error running %s: %s" % (self.command, e))
+            # the browser ran for a while, it is not failing in a loop
+            if time.time() - started > self.max_backoff:
+                backoff = 1
+            time.sleep(backoff)
+            backoff = min(backoff * 2, self.max_backoff)
+            self.restarts += 1
+
+    def parse(self, line):
+        l = line.split(";")
+        if len(l) < 6:
+            return
+        key = (l[1], l[2], l[3])
+        self.lock.acquire()
+        if l[0] == "=" and len(l) >= 8:
+            d = {}
+            d["hostname"] = l[3]
+            if l[2] == "IPv4":
+                d["ipv4"] = l[7]
+            elif l[2] == "IPv6":
+                d["ipv6"] = l[7]
+            self.services[key] = (time.time(), d)
+        elif l[0] == "-" and key in self.services.keys():
+            del self.services[key]
+        self.lock.release()
+
+    def get_servers(self):
+        # one entry per hostname, with the addresses of all its services
+        servers = {}
+        now = time.time()
+        self.lock.acquire()
+        for key in list(self.services.keys()):
+            (seen, d) = self.services[key]
+            if seen < self.restarted and now - self.restarted > self.expire:
+                del self.services[key]
+                continue
+            if not d["hostname"] in servers.keys():
+                servers[d["hostname"]] = {"hostname": d["hostname"]}
+            servers[d["hostname"]].update(d)
+        self.lock.release()
+        server_list = []
+        for s in servers.values():
+            # the auto-discovered clients cannot be accessed with the REST URL
+            s["id"] = -1
+            server_list.append(s)
+        return server_list
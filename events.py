@@ -0,0 +1,47 @@
+import collections
+import json
+import threading
+
+class EventLog:
+    """Recent job events, pushed to the clients following the jobs.
+
+    Each event gets a sequence number and the last size events are kept in
+    a ring, so a client reconnecting with the last number it received gets
+    the events it missed. A client further behind than the ring (or with a
+    number from before a restart) has to reload the jobs list. The events
+    are serialized once, whatever the number of clients.
+    """
+    def __init__(self, size=1000):
+        self.cond = threading.Condition()
+        # (sequence number, type, JSON data)
+        self.events = collections.deque(maxlen=size)
+        self.seq = 0
+
+    def publish(self, type, data):
+        data = json.dumps(data)
+        self.cond.acquire()
+        self.seq += 1
+        self.events.append((self.seq, type, data))
+        self.cond.notify_all()
+        self.cond.release()
+
+    def cursor(self):
+        self.cond.acquire()
+        seq = self.seq
+        self.cond.release()
+        return seq
+
+    def since(self, cursor, timeout):
+        # waits up to timeout seconds for events after cursor, returns the
+        # new cursor and the events, or None if some of them were dropped
+        self.cond.acquire()
+        if cursor <= self.seq:
+            self.cond.wait_for(lambda: self.seq > cursor, timeout)
+        if cursor > self.seq or (self.events and self.events[0][0] > cursor + 1):
+            seq = self.seq
+            self.cond.release()
+            return (seq, None)
+        events = [e for e in self.events if e[0] > cursor]
+        seq = self.seq
+        self.cond.release()
+        return (seq, events)
@@ -0,0 +1,88 @@
+import asyncio
+import threading
+
+class JobEngine:
+    """Run the job phases on an asyncio event loop.
+
+    The loop runs in its own thread, the Flask handlers only hand it work.
+    A phase is a coroutine function taking the task as argument. It is
+    either queued to run as soon as a worker is free (submit), or after a
+    delay (add_timer, from the loop). Workers are coroutines consuming the queue, so the
+    number of jobs in flight is bounded by the configured number of workers,
+    and a job waiting for the end of its tracing window is only a timer.
+    """
+    def __init__(self, workers=64):
+        self.nworkers = workers
+        self.busy = 0
+        self.waiting = 0
+        self.loop = asyncio.new_event_loop()
+        self.ready = threading.Event()
+        self.thread = threading.Thread(name="jobs", target=self.run_loop)
+        self.thread.daemon = True
+        self.thread.start()
+        self.ready.wait()
+
+    def run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.queue = asyncio.Queue()
+        for i in range(self.nworkers):
+            self.loop.create_task(self.worker())
+        self.loop.call_soon(self.ready.set)
+        self.loop.run_forever()
+
+    def submit(self, task, phase):
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, (task, phase))
+
+    def add_timer(self, delay, task, phase):
+        # on the loop
+        self.waiting += 1
+        task["timer"] = (self.loop.call_later(delay, self.timer_expired, task, phase),
+                phase)
+
+    def timer_expired(self, task, phase):
+        self.waiting -= 1
+        del task["timer"]
+        self.queue.put_nowait((task, phase))
+
+    def expire(self, task):
+        # on the loop, run the phase scheduled for the task right away,
+        # returns False if there is none
+        if not "timer" in task.keys():
+            return False
+        (handle, phase) = task["timer"]
+        handle.cancel()
+        self.timer_expired(task, phase)
+        return True
+
+    def periodic(self, interval, func):
+        # call func on the loop every interval seconds
+        def tick():
+            try:
+                func()
+            except Exception as e:
+                print("Uncaught exception in %s: %s" % (func.__name__, e))
+            self.loop.call_later(interval, tick)
+        self.loop.call_soon_threadsafe(self.loop.call_later, interval, tick)
+
+    def run(self, coro):
+        # run a coroutine on the loop from another thread and wait for it
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    async def worker(self):
+        while True:
+            (task, phase) = await self.queue.get()
+            self.busy += 1
+            try:
+                await phase(task)
+            except Exception as e:
+                print("Job %d: uncaught exception in %s: %s" % (task["jobid"],
+                    phase.__name__, e))
+            self.busy -= 1
+
+    def stats(self):
+        s = {}
+        s["workers"] = self.nworkers
+        s["busy"] = self.busy
+        s["queued"] = self.queue.qsize()
+        s["waiting"] = self.waiting
+        return s
@@ -0,0 +1,205 @@
+import collections
+import json
+import sqlite3
+import threading
+import time
+
+class JobStore:
+    """Durable state of the jobs, in the jobs and job_hosts tables of the
+    configuration database.
+
+    The job details (as returned by the REST API) are stored as JSON, the
+    columns used to filter the listings are indexed. A job traces several
+    hosts, so the hosts are in their own table.
+
+    The updates are written by a thread of their own, so a writer holding
+    the database never stalls the callers (the job engine loop). Only the
+    last state of a job waiting to be written is kept, and a failed write
+    is retried after retry_delay seconds. An update comes with the sequence
+    number of the job events before it, unwritten_since() tells from which
+    event on the listings may lag behind.
+    """
+    def __init__(self, db, owner, retry_delay=1):
+        self.db = db
+        # name of this controller, to recover its jobs after a restart
+        self.owner = owner
+        self.retry_delay = retry_delay
+        self.cond = threading.Condition()
+        # job ID -> (details, update time, events sequence number), written
+        # in the order of the IDs
+        self.pending = {}
+        self.order = collections.deque()
+        # events sequence number of the update being written
+        self.writing = None
+        self.writer = threading.Thread(name="jobstore", target=self.write_updates)
+        self.writer.daemon = True
+        self.writer.start()
+
+    def create_tables(self, cur):
+        cur.execute("CREATE TABLE jobs (id INTEGER PRIMARY KEY, type TEXT, status TEXT, "
+            "created REAL, updated REAL, owner TEXT, details TEXT)")
+        cur.execute("CREATE INDEX jobs_status ON jobs (status, id)")
+        cur.execute("CREATE INDEX jobs_created ON jobs (created)")
+        cur.execute("CREATE TABLE job_hosts (jobid INT, host TEXT)")
+        cur.execute("CREATE INDEX job_hosts_host ON job_hosts (host, jobid)")
+        cur.execute("CREATE INDEX job_hosts_jobid ON job_hosts (jobid)")
+
+    def create(self, type, status, hosts, details=None):
+        # returns the new job ID, unique across all the controllers sharing
+        # the database, the row is listed with its initial details right away
+        now = time.time()
+        job = dict(details or {})
+        job["type"] = type
+        job["status"] = status
+        job.setdefault("created", now)
+        job["hosts"] = [{"host": h} for h in hosts]
+        with self.db.pooled() as con:
+            with con:
+                cur = con.cursor()
+                cur.execute("INSERT INTO jobs VALUES(NULL,?,?,?,?,?,NULL)",
+                        (type, status, job["created"], now, self.owner))
+                jobid = cur.lastrowid
+                job["jobid"] = jobid
+                cur.execute("UPDATE jobs SET details=:details WHERE id=:id",
+                        {"details": json.dumps(job), "id": jobid})
+                cur.executemany("INSERT INTO job_hosts VALUES(?,?)",
+                        [(jobid, h) for h in hosts])
+        return jobid
+
+    def update(self, job, since=None):
+        # since: sequence number of the job events before this update
+        self.queue_update(job, time.time(), since)
+
+    def queue_update(self, job, updated, since):
+        with self.cond:
+            if not job["jobid"] in self.pending.keys():
+                self.order.append(job["jobid"])
+            else:
+                # the older state is not written either
+                since = self.min_since(since, self.pending[job["jobid"]][2])
+            self.pending[job["jobid"]] = (job, updated, since)
+            self.cond.notify()
+
+    def min_since(self, a, b):
+        if a is None:
+            return b
+        if b is None:
+            return a
+        return min(a, b)
+
+    def unwritten_since(self):
+        # the lowest sequence number of the updates not written yet, or None
+        with self.cond:
+            since = self.writing
+            for p in self.pending.values():
+                since = self.min_since(since, p[2])
+        return since
+
+    def write_updates(self):
+        while True:
+            with self.cond:
+                while not self.order:
+                    self.cond.wait()
+                jobid = self.order.popleft()
+                (job, updated, since) = self.pending.pop(jobid)
+                self.writing = since
+            try:
+                self.write(job, updated)
+                with self.cond:
+                    self.writing = None
+            except sqlite3.Error as e:
+                print("Job %d: cannot store the job: %s" % (jobid, e))
+                time.sleep(self.retry_delay)
+                with self.cond:
+                    self.writing = None
+                    if jobid in self.pending.keys():
+                        # a newer state is waiting, written instead
+                        p = self.pending[jobid]
+                        self.pending[jobid] = (p[0], p[1], self.min_since(since, p[2]))
+                    else:
+                        self.order.append(jobid)
+                        self.pending[jobid] = (job, updated, since)
+
+    def write(self, job, updated):
+        con = self.db.connection()
+        with con:
+            cur = con.cursor()
+            cur.execute("UPDATE jobs SET status=:status, updated=:updated, "
+                    "details=:details WHERE id=:id",
+                    {"status": job["status"], "updated": updated,
+                        "details": json.dumps(job), "id": job["jobid"]})
+
+    def delete(self, jobid):
+        with self.cond:
+            if self.pending.pop(jobid, None) is not None:
+                self.order.remove(jobid)
+        with self.db.pooled() as con:
+            with con:
+                cur = con.cursor()
+                cur.execute("DELETE FROM job_hosts WHERE jobid=:id", {"id": jobid})
+                cur.execute("DELETE FROM jobs WHERE id=:id", {"id": jobid})
+
+    def get(self, jobid):
+        with self.db.pooled() as con:
+            with con:
+                cur = con.cursor()
+                cur.execute("SELECT details FROM jobs WHERE id=:id", {"id": jobid})
+                rq = cur.fetchall()
+        if rq and rq[0][0]:
+            return json.loads(rq[0][0])
+        return None
+
+    def list(self, status=None, host=None, type=None, since=None, before=None,
+            limit=100):
+        # most recent jobs first, "before" is the pagination cursor (a job ID)
+        where = []
+        args = {"limit": limit}
+        if status is not None:
+            where.append("status=:status")
+            args["status"] = status
+        if type is not None:
+            where.append("type=:type")
+            args["type"] = type
+        if host is not None:
+            where.append("id IN (SELECT jobid FROM job_hosts WHERE host=:host)")
+            args["host"] = host
+        if since is not None:
+            where.append("created>=:since")
+            args["since"] = since
+        if before is not None:
+            where.append("id<:before")
+            args["before"] = before
+        query = "SELECT id, details FROM jobs"
+        if where:
+            query += " WHERE " + " AND ".join(where)
+        query += " ORDER BY id DESC LIMIT :limit"
+
+        jobs = []
+        with self.db.pooled() as con:
+            with con:
+                cur = con.cursor()
+                cur.execute(query, args)
+                for (jobid, details) in cur.fetchall():
+                    if details:
+                        jobs.append(json.loads(details))
+        return jobs
+
+    def recover(self):
+        # the jobs of this controller still in flight were interrupted by
+        # a restart
+        with self.db.pooled() as con:
+            with con:
+                cur = con.cursor()
+                cur.execute("SELECT id, details FROM jobs WHERE owner=:owner AND "
+                        "status NOT IN ('done', 'error', 'cancelled')", {"owner": self.owner})
+                for (jobid, details) in cur.fetchall():
+                    job = {}
+                    if details:
+                        job = json.loads(details)
+                    job["jobid"] = jobid
+                    job["status"] = "error"
+                    job["error"] = "Interrupted by a controller restart\n"
+                    cur.execute("UPDATE jobs SET status=:status, updated=:updated, "
+                            "details=:details WHERE id=:id",
+                            {"status": job["status"], "updated": time.time(),
+                                "details": json.dumps(job), "id": jobid})
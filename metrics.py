@@ -0,0 +1,86 @@
+import threading
+
+class Metrics:
+    """Counters and latency distributions, exported in the Prometheus text
+    format.
+
+    A histogram counts the observations in fixed buckets, a summary only
+    keeps their sum and count, which is cheaper for the high cardinality
+    labels such as the host. The gauges, and the counters kept elsewhere,
+    are computed by the caller when the metrics are rendered.
+    """
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # name -> (type, help)
+        self.descriptions = {}
+        # (name, labels) -> value, or [bucket counts, sum, count]
+        self.values = {}
+
+    def describe(self, name, type, help):
+        self.descriptions[name] = (type, help)
+
+    def labels_key(self, labels):
+        return tuple(sorted(labels.items()))
+
+    def inc(self, name, labels, value=1):
+        key = (name, self.labels_key(labels))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        key = (name, self.labels_key(labels))
+        with self.lock:
+            v = self.values.get(key)
+            if v is None:
+                v = [[0] * len(self.BUCKETS), 0, 0]
+                self.values[key] = v
+            if self.descriptions[name][0] == "histogram":
+                for (i, b) in enumerate(self.BUCKETS):
+                    if value <= b:
+                        v[0][i] += 1
+            v[1] += value
+            v[2] += 1
+
+    def format_labels(self, labels):
+        if not labels:
+            return ""
+        l = []
+        for (k, v) in labels:
+            v = str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+            l.append("%s=\"%s\"" % (k, v))
+        return "{%s}" % ",".join(l)
+
+    def render(self, gauges=(), counters=()):
+        # gauges and counters: (name, help, [(labels, value)]) computed at
+        # scrape time
+        lines = []
+        with self.lock:
+            values = sorted(self.values.items())
+        described = set()
+        for ((name, labels), v) in values:
+            (type, help) = self.descriptions[name]
+            if not name in described:
+                lines.append("# HELP %s %s" % (name, help))
+                lines.append("# TYPE %s %s" % (name, type))
+                described.add(name)
+            if type == "counter":
+                lines.append("%s%s %s" % (name, self.format_labels(labels), v))
+                continue
+            if type == "histogram":
+                for (i, b) in enumerate(self.BUCKETS):
+                    lines.append("%s_bucket%s %d" % (name,
+                        self.format_labels(labels + (("le", b),)), v[0][i]))
+                lines.append("%s_bucket%s %d" % (name,
+                    self.format_labels(labels + (("le", "+Inf"),)), v[2]))
+            lines.append("%s_sum%s %s" % (name, self.format_labels(labels), v[1]))
+            lines.append("%s_count%s %d" % (name, self.format_labels(labels), v[2]))
+        for (type, metrics) in [("gauge", gauges), ("counter", counters)]:
+            for (name, help, samples) in metrics:
+                lines.append("# HELP %s %s" % (name, help))
+                lines.append("# TYPE %s %s" % (name, type))
+                for (labels, value) in samples:
+                    lines.append("%s%s %s" % (name,
+                        self.format_labels(tuple(sorted(labels.items()))), value))
+        return "\n".join(lines) + "\n"
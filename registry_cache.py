@@ -0,0 +1,77 @@
+import hashlib
+import json
+import threading
+import time
+
+class RegistryCache:
+    """In-memory copy of the registry tables (relays, clients, analyses).
+
+    A table is loaded from the database on the first read, then served from
+    memory until one of the add/update/delete paths invalidates it. Entries
+    also expire after ttl seconds, to catch the changes made by another
+    controller sharing the database. The tables of more than max_rows rows
+    are not kept in memory, their listings are streamed from the database.
+    """
+    def __init__(self, ttl=30, max_rows=1000):
+        self.ttl = ttl
+        self.max_rows = max_rows
+        self.lock = threading.Lock()
+        # table -> cached entry
+        self.entries = {}
+        # table -> number of invalidations, to detect a change during a load
+        self.versions = {}
+        # table -> time of the last invalidation
+        self.modified = {}
+        # table -> time it was found too large to be cached
+        self.large = {}
+
+    def get(self, table, load):
+        # returns a dict with the rows, the JSON body, its etag and the last
+        # modification time of the table, or None if the table is too large,
+        # load(limit) returns at most limit rows of the table
+        self.lock.acquire()
+        previous = self.entries.get(table)
+        version = self.versions.get(table, 0)
+        large = self.large.get(table)
+        self.lock.release()
+        if previous and time.time() - previous["loaded"] <= self.ttl:
+            return previous
+        if large and time.time() - large <= self.ttl:
+            return None
+
+        entry = {}
+        entry["loaded"] = time.time()
+        entry["rows"] = load(self.max_rows + 1)
+        if len(entry["rows"]) > self.max_rows:
+            self.lock.acquire()
+            if self.versions.get(table, 0) == version:
+                self.large[table] = entry["loaded"]
+                if table in self.entries.keys():
+                    del self.entries[table]
+            self.lock.release()
+            return None
+        entry["body"] = json.dumps(entry["rows"])
+        entry["etag"] = hashlib.sha1(entry["body"].encode()).hexdigest()
+        self.lock.acquire()
+        # changed behind our back (expired entry), or first load
+        if not table in self.modified.keys() or \
+                (previous and previous["etag"] != entry["etag"]):
+            self.modified[table] = entry["loaded"]
+        entry["modified"] = self.modified[table]
+        # only keep the entry if the table did not change in the meantime
+        if self.versions.get(table, 0) == version:
+            self.entries[table] = entry
+        self.lock.release()
+        return entry
+
+    def invalidate(self, table):
+        self.lock.acquire()
+        self.versions[table] = self.versions.get(table, 0) + 1
+        self.modified[table] = time.time()
+        if table in self.entries.keys():
+            del self.entries[table]
+        if table in self.large.keys():
+            del self.large[table]
+        self.lock.release()
+
+registry_cache = RegistryCache()
@@ -1,9 +1,16 @@
 import sqlite3
 from tracevisor import *
+from registry_cache import registry_cache
 from client import *
 from analyses_servers import *
 
 class Relay(Tracevisor):
+    # values of the fields missing when registering a relay
+    DEFAULTS = {"ipv4": "", "ipv6": "", "ctrlport": 5342, "dataport": 5343,
+            "maxsessions": 0, "sshuser": "root", "sshport": 22}
+    RANGES = {"ctrlport": Tracevisor.PORT_RANGE, "dataport": Tracevisor.PORT_RANGE,
+            "maxsessions": (0, 1 << 31), "sshport": Tracevisor.PORT_RANGE}
+
     def __init__(self):
         pass
 
@@ -15,21 +22,46 @@ class Relay(Tracevisor):
         relay["ipv6"] = rq[3]
         relay["ctrlport"] = rq[4]
         relay["dataport"] = rq[5]
+        relay["maxsessions"] = rq[6]
+        relay["sshuser"] = rq[7]
+        relay["sshport"] = rq[8]
         return relay
 
-    def get_relays_list(self):
+    def relay_address(self, relay):
+        if relay["ipv4"]:
+            return relay["ipv4"]
+        elif relay["ipv6"]:
+            return relay["ipv6"]
+        return relay["hostname"]
+
+    def relay_url(self, relay):
+        # the relay with its ports, as expected by lttng create -U net://
+        address = self.relay_address(relay)
+        if ":" in address:
+            address = "[%s]" % address
+        return "%s:%d:%d" % (address, relay["ctrlport"], relay["dataport"])
+
+    def get_relays(self):
+        # all the registered relays, for the placement of the sessions
+        entry = registry_cache.get("relays", self.load_relays)
+        if entry is not None:
+            return entry["rows"]
+        return self.load_relays()
+
+    def load_relays(self, limit=-1):
         relays = []
-        resp = None
         self.connect_db()
         cur = self.con.cursor()
         with self.con:
-            cur.execute("SELECT * FROM relays")
+            cur.execute("SELECT * FROM relays ORDER BY id LIMIT :limit", {"limit": limit})
             r = cur.fetchall()
             for i in r:
                 relays.append(self.rq_to_relay(i))
-            resp = Response(json.dumps(relays), mimetype="application/json")
         self.disconnect_db()
-        return resp
+        return relays
+
+    def get_relays_list(self):
+        return self.registry_listing("relays", self.rq_to_relay, self.load_relays)
 
     def get_relay(self, cur, hostname):
         cur.execute("SELECT * FROM relays WHERE hostname=:hostname", {"hostname": hostname})
@@ -39,28 +71,23 @@ class Relay(Tracevisor):
         return None
 
     def get_relay_id(self, relay_id):
-        self.connect_db()
-        with self.con:
-            cur = self.con.cursor()
-            cur.execute("SELECT * FROM relays WHERE id=:id", {"id": relay_id})
-            rq = cur.fetchall()
-            if rq:
-                ret = Response(json.dumps(self.rq_to_relay(rq[0])), mimetype="application/json")
-            else:
-                ret = "Unknown relay ID %d\n" % relay_id, 503
-        self.disconnect_db()
+        relay = self.registry_get("relays", self.rq_to_relay, self.load_relays, relay_id)
+        if relay is None:
+            return "Unknown relay ID %d\n" % relay_id, 503
+        return self.json_response(json.dumps(relay))
+
+    def insert_relay(self, cur, fields, update=()):
+        # create the relay, or update the "update" fields of the existing one
+        # with the same hostname, returns its ID
+        return self.upsert(cur, "relays", fields, update)
+
+    def bulk_relays(self):
+        ret = self.bulk_import("relays", self.DEFAULTS, self.RANGES)
+        registry_cache.invalidate("relays")
         return ret
 
-    def insert_relay(self, cur, fields):
-        ret = self.get_relay(cur, fields["hostname"])
-        if ret:
-            return -1
-        cur.execute("INSERT INTO relays VALUES(NULL,?,?,?,?,?)",
-                (fields["hostname"], fields["ipv4"], fields["ipv6"], fields["ctrlport"],
-                    fields["dataport"]))
-        cur.execute("SELECT MAX(ID) FROM relays WHERE hostname=:hostname", fields)
-        r = cur.fetchall()
-        return r[0][0]
+    def export_relays(self):
+        return self.export_table("relays", self.rq_to_relay)
 
     def delete_relay(self, relay_id):
         self.connect_db()
@@ -68,6 +95,7 @@ class Relay(Tracevisor):
         with self.con:
             cur.execute("DELETE FROM relays WHERE id=:id", {"id":relay_id})
         self.disconnect_db()
+        registry_cache.invalidate("relays")
         return "Done"
 
     def add_relay(self):
@@ -80,19 +108,16 @@ class Relay(Tracevisor):
                 abort(400)
         if not "ipv4" in request.json and not "ipv6" in request.json:
             return "Missing IPv4 or IPv6 address\n", 400
+        bad = self.invalid_int(request.json, self.RANGES)
+        if bad is not None:
+            return "Invalid %s\n" % bad, 400
 
         self.connect_db()
         with self.con:
             cur = self.con.cursor()
             hostname = request.json["hostname"]
-            rq = self.get_relay(cur, hostname)
-            if not rq:
-                rq = {}
-                rq["hostname"] = hostname
-                rq["ipv4"] = ""
-                rq["ipv6"] = ""
-                rq["ctrlport"] = 5342
-                rq["dataport"] = 5343
+            rq = dict(self.DEFAULTS)
+            rq["hostname"] = hostname
             if "ipv4" in request.json:
                 rq["ipv4"] = request.json["ipv4"]
             if "ipv6" in request.json:
@@ -101,15 +126,24 @@ class Relay(Tracevisor):
                 rq["ctrlport"] = request.json["ctrlport"]
             if "dataport" in request.json:
                 rq["dataport"] = request.json["dataport"]
-            ret = self.insert_relay(cur, rq)
-            if ret > 0:
-                ret = "%s/%d" % (request.url, ret)
-            else:
-                ret = "Relay %s already exists\n" % hostname, 503
+            if "maxsessions" in request.json:
+                rq["maxsessions"] = request.json["maxsessions"]
+            if "sshuser" in request.json:
+                rq["sshuser"] = request.json["sshuser"]
+            if "sshport" in request.json:
+                rq["sshport"] = request.json["sshport"]
+            ret = self.insert_relay(cur, rq, request.json.keys())
+            ret = "%s/%d" % (request.url, ret)
         self.disconnect_db()
+        registry_cache.invalidate("relays")
         return ret
 
     def update_relay(self, relay_id):
+        if not request.json:
+            abort(400)
+        bad = self.invalid_int(request.json, self.RANGES)
+        if bad is not None:
+            return "Invalid %s\n" % bad, 400
         self.connect_db()
         cur = self.con.cursor()
         cur.execute("SELECT * FROM relays WHERE id=:id", {"id": relay_id})
@@ -131,9 +165,21 @@ class Relay(Tracevisor):
             relay["ctrlport"] = request.json["ctrlport"]
         if "dataport" in request.json:
             relay["dataport"] = request.json["dataport"]
+        if "maxsessions" in request.json:
+            relay["maxsessions"] = request.json["maxsessions"]
+        if "sshuser" in request.json:
+            relay["sshuser"] = request.json["sshuser"]
+        if "sshport" in request.json:
+            relay["sshport"] = request.json["sshport"]
 
-        cur.execute("UPDATE relays SET hostname=:hostname, ipv4=:ipv4, ipv6=:ipv6,"
-                "ctrlport=:ctrlport, dataport=:dataport WHERE id=:id", (relay))
+        try:
+            cur.execute("UPDATE relays SET hostname=:hostname, ipv4=:ipv4, ipv6=:ipv6,"
+                    "ctrlport=:ctrlport, dataport=:dataport, maxsessions=:maxsessions, "
+                    "sshuser=:sshuser, sshport=:sshport WHERE id=:id", (relay))
+        except sqlite3.IntegrityError:
+            self.disconnect_db()
+            return "Relay %s already exists\n" % relay["hostname"], 503
         self.con.commit()
+        registry_cache.invalidate("relays")
         self.disconnect_db()
         return "%s" % (request.url)
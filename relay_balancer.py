@@ -0,0 +1,87 @@
+import math
+import threading
+import time
+
+class RelayBalancer:
+    """Placement of the tracing sessions on the registered relays.
+
+    The load of a relay is its number of active sessions, plus its recent
+    throughput counted in sessions of session_bandwidth bytes per second.
+    The throughput is the volume of the traces received by the relay,
+    decayed with a time constant of tau seconds. A relay with a maxsessions
+    above 0 never gets more active sessions than that.
+    """
+    def __init__(self, session_bandwidth=10 * 1024 * 1024, tau=60):
+        self.session_bandwidth = session_bandwidth
+        self.tau = tau
+        self.lock = threading.Lock()
+        # relay ID -> number of active sessions
+        self.sessions = {}
+        # relay ID -> (timestamp, decayed volume in bytes)
+        self.volume = {}
+        # relay ID -> time of the last placement, to spread the ties
+        self.assigned = {}
+
+    def rate(self, relay_id, now):
+        # recent throughput in bytes per second, lock held
+        if not relay_id in self.volume.keys():
+            return 0
+        (t, v) = self.volume[relay_id]
+        return v * math.exp(-(now - t) / self.tau) / self.tau
+
+    def load(self, relay_id, now):
+        return self.sessions.get(relay_id, 0) + \
+                self.rate(relay_id, now) / self.session_bandwidth
+
+    def acquire(self, relays, count, reserve=True):
+        # choose a relay for each of count sessions, returns the list of
+        # relays or None if they are all at capacity, without reserve the
+        # sessions are only spread, not accounted
+        now = time.time()
+        chosen = []
+        with self.lock:
+            for i in range(count):
+                best = None
+                for r in relays:
+                    if reserve and r["maxsessions"] and \
+                            self.sessions.get(r["id"], 0) >= r["maxsessions"]:
+                        continue
+                    key = (self.load(r["id"], now), self.assigned.get(r["id"], 0))
+                    if best is None or key < best[0]:
+                        best = (key, r)
+                if best is None:
+                    break
+                r = best[1]
+                self.sessions[r["id"]] = self.sessions.get(r["id"], 0) + 1
+                self.assigned[r["id"]] = now + i * 1e-6
+                chosen.append(r)
+            if len(chosen) < count or not reserve:
+                # all or nothing
+                for r in chosen:
+                    self.sessions[r["id"]] -= 1
+        if len(chosen) < count:
+            return None
+        return chosen
+
+    def release(self, relay_id):
+        with self.lock:
+            if self.sessions.get(relay_id, 0) > 0:
+                self.sessions[relay_id] -= 1
+
+    def record(self, relay_id, nbytes):
+        # a relay received nbytes of traces
+        now = time.time()
+        with self.lock:
+            v = self.rate(relay_id, now) * self.tau
+            self.volume[relay_id] = (now, v + nbytes)
+
+    def stats(self):
+        now = time.time()
+        s = {}
+        with self.lock:
+            for relay_id in set(self.sessions.keys()) | set(self.volume.keys()):
+                r = {}
+                r["sessions"] = self.sessions.get(relay_id, 0)
+                r["throughput"] = int(self.rate(relay_id, now))
+                s[relay_id] = r
+        return s
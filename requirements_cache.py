@@ -0,0 +1,44 @@
+import threading
+import time
+
+class RequirementsCache:
+    """Results of the successful preflight checks, per (host, username).
+
+    An entry is valid for ttl seconds, it is dropped earlier when a job on
+    the host fails or when the client registered for the host changes.
+    """
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # (host, username) -> (timestamp, results)
+        self.entries = {}
+
+    def get(self, host, username):
+        key = (host, username)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and time.time() - entry[0] > self.ttl:
+                del self.entries[key]
+                entry = None
+        if entry:
+            return dict(entry[1])
+        return None
+
+    def set(self, host, username, results):
+        with self.lock:
+            self.entries[(host, username)] = (time.time(), dict(results))
+
+    def invalidate(self, host, username):
+        with self.lock:
+            self.entries.pop((host, username), None)
+
+    def clear(self):
+        with self.lock:
+            self.entries = {}
+
+    def invalidate_host(self, names):
+        # drop the entries of all the users for any of the host names
+        with self.lock:
+            for key in list(self.entries.keys()):
+                if key[0] in names:
+                    del self.entries[key]
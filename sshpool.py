@@ -0,0 +1,176 @@
+import asyncio
+import hashlib
+import os
+import signal
+import subprocess
+import threading
+import time
+
+class SSHPool:
+    """Pool of multiplexed SSH connections, one per (host, user, port).
+
+    Each remote command goes through an OpenSSH ControlMaster, so only the
+    first command to a host pays for the TCP connection and the key exchange,
+    the following ones reuse the authenticated channel. Masters that have not
+    been used for idle_timeout seconds are closed. A command still running
+    after timeout seconds (unless the caller sets its own) is killed and
+    fails.
+    """
+    def __init__(self, ssh, idle_timeout=300, control_dir=None, timeout=60):
+        self.ssh = ssh
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        if control_dir is None:
+            control_dir = os.path.join(os.environ["HOME"], ".ssh", "tracevisor-mux")
+        os.makedirs(control_dir, mode=0o700, exist_ok=True)
+        self.control_dir = control_dir
+        self.lock = threading.Lock()
+        # (host, username, port) -> last time the channel was used
+        self.channels = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # commands failed, and among them the ssh connection failures
+        self.failures = 0
+        self.connection_failures = 0
+        self.timeouts = 0
+
+    def failed(self, returncode):
+        # ssh exits with 255 when the connection itself failed
+        with self.lock:
+            self.failures += 1
+            if returncode == 255:
+                self.connection_failures += 1
+
+    def control_path(self, username, host, port):
+        # unix socket paths are limited to ~100 chars, use a short hash
+        key = "%s@%s:%d" % (username, host, port)
+        return os.path.join(self.control_dir,
+                hashlib.sha1(key.encode()).hexdigest()[:16])
+
+    def base_command(self, username, host, port):
+        return "%s -p %d -oControlMaster=auto -oControlPath=%s " \
+                "-oControlPersist=%d %s@%s" % (self.ssh, port,
+                        self.control_path(username, host, port),
+                        self.idle_timeout, username, host)
+
+    def acquire(self, username, host, port=22):
+        # account for the channel usage and return the ssh command prefix
+        key = (host, username, port)
+        now = time.time()
+        master = os.path.exists(self.control_path(username, host, port))
+        with self.lock:
+            if key in self.channels and master:
+                self.hits += 1
+            else:
+                self.misses += 1
+            self.channels[key] = now
+        return self.base_command(username, host, port)
+
+    def command(self, username, host, cmd, port=22):
+        return "%s %s" % (self.acquire(username, host, port), cmd)
+
+    def command_timeout(self, timeout):
+        # None for the default timeout, 0 for none
+        if timeout is None:
+            timeout = self.timeout
+        if not timeout:
+            return None
+        return timeout
+
+    def timed_out(self):
+        with self.lock:
+            self.timeouts += 1
+
+    def kill(self, proc):
+        # the commands run in their own process group, with the shell, the
+        # ssh client is killed too (the ControlPersist masters detach from
+        # the group)
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    async def run_async(self, username, host, cmd, port=22, input=None, timeout=None,
+            procs=None):
+        # procs: set holding the process while it runs, to kill it on demand
+        cmd = self.command(username, host, cmd, port)
+        proc = await asyncio.create_subprocess_shell(cmd,
+                stdin=subprocess.PIPE if input is not None else subprocess.DEVNULL,
+                stdout=subprocess.PIPE, start_new_session=True)
+        if procs is not None:
+            procs.add(proc)
+        # keep the output read before a timeout
+        chunks = []
+        try:
+            await asyncio.wait_for(self.communicate(proc, input, chunks),
+                    self.command_timeout(timeout))
+        except asyncio.TimeoutError:
+            self.kill(proc)
+            await proc.wait()
+            self.timed_out()
+        finally:
+            if procs is not None:
+                procs.discard(proc)
+        out = b"".join(chunks)
+        if proc.returncode != 0:
+            self.failed(proc.returncode)
+            raise subprocess.CalledProcessError(proc.returncode, cmd, output=out)
+        return out
+
+    async def communicate(self, proc, input, chunks):
+        if input is not None:
+            try:
+                proc.stdin.write(input)
+                await proc.stdin.drain()
+                proc.stdin.close()
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+        while True:
+            chunk = await proc.stdout.read(64 * 1024)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        await proc.wait()
+
+    async def open_async(self, username, host, cmd, port=22, stdin=None, stdout=None):
+        # start a remote command and return the process, to stream its
+        # input or output, the caller handles its timeout
+        cmd = self.command(username, host, cmd, port)
+        return await asyncio.create_subprocess_shell(cmd,
+                stdin=stdin if stdin is not None else subprocess.DEVNULL,
+                stdout=stdout, start_new_session=True)
+
+    async def close(self, username, host, port):
+        proc = await asyncio.create_subprocess_shell(
+                "%s -p %d -oControlPath=%s -O exit %s@%s" % (self.ssh, port,
+                    self.control_path(username, host, port), username, host),
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        await proc.wait()
+
+    async def evict_idle(self):
+        # called periodically on the loop, the masters are closed without
+        # blocking the other commands
+        to_evict = []
+        now = time.time()
+        with self.lock:
+            for key in list(self.channels.keys()):
+                if now - self.channels[key] > self.idle_timeout:
+                    to_evict.append(key)
+                    del self.channels[key]
+                    self.evictions += 1
+
+        for (host, username, port) in to_evict:
+            await self.close(username, host, port)
+
+    def stats(self):
+        with self.lock:
+            s = {}
+            s["channels"] = len(self.channels)
+            s["hits"] = self.hits
+            s["misses"] = self.misses
+            s["evictions"] = self.evictions
+            s["failures"] = self.failures
+            s["connection_failures"] = self.connection_failures
+            s["timeouts"] = self.timeouts
+        return s
@@ -6,7 +6,7 @@ if test "$a" = 'n'; then
 	exit 0
 else
 	pgrep tracevisor.py | xargs kill 2>/dev/null
-	rm config.db
+	rm -f config.db config.db-wal config.db-shm
 	./tracevisor.py &
 	[ $? = 0 ] || exit 1
 	echo "Arbitrary sleep before tracevisor is ready"
@@ -26,6 +26,18 @@ echo "GET SSH KEYS"
 curl -s -i http://localhost:5000/trace/api/v1.0/ssh | grep 200 >/dev/null
 [ $? = 0 ] || exit 1
 
+echo "GET SSH POOL STATS"
+curl -s -i http://localhost:5000/trace/api/v1.0/sshpool | grep 200 >/dev/null
+[ $? = 0 ] || exit 1
+
+echo "FOLLOW THE JOBS"
+curl -s -N --max-time 1 http://localhost:5000/trace/api/v1.0/events | grep retry >/dev/null
+[ $? = 0 ] || exit 1
+
+echo "GET METRICS"
+curl -s http://localhost:5000/metrics | grep tracevisor_active_sessions >/dev/null
+[ $? = 0 ] || exit 1
+
 
 
 # Relay requests
@@ -45,6 +57,18 @@ echo "UPDATE RELAY 1"
 curl -i -s -H "Content-Type: application/json" -X PUT -d '{"hostname": "myrelayhostname2", "ipv6":"fe80::1" }' http://localhost:5000/trace/api/v1.0/relays/1 | grep 200 >/dev/null
 [ $? = 0 ] || exit 1
 
+echo "BULK REGISTER RELAYS"
+curl -s -i -H "Content-Type: application/json" -X POST -d '[{"hostname": "myrelay2", "ipv4":"10.0.0.2" }, {"hostname": "myrelay3", "ipv4":"10.0.0.3" }]' http://localhost:5000/trace/api/v1.0/relays/bulk | grep 200 >/dev/null
+[ $? = 0 ] || exit 1
+
+echo "LIST RELAYS PAGE"
+curl -i -s "http://localhost:5000/trace/api/v1.0/relays?hostname=myrelay&limit=1" | grep X-Next-Cursor >/dev/null
+[ $? = 0 ] || exit 1
+
+echo "EXPORT RELAYS"
+curl -i -s http://localhost:5000/trace/api/v1.0/relays/export | grep 200 >/dev/null
+[ $? = 0 ] || exit 1
+
 echo "DELETE RELAY 1"
 curl -i -s -H "Content-Type: application/json" -X DELETE http://localhost:5000/trace/api/v1.0/relays/1 | grep 200 >/dev/null
 [ $? = 0 ] || exit 1
@@ -1,10 +1,17 @@
 #!/usr/bin/python3
 
+import asyncio
+import collections
+import hashlib
 import json
 import os
+import re
+import shlex
+import socket
 import subprocess
 import time
 import threading
+import zlib
 from flask import Flask
 from flask import Response
 from flask import request
@@ -13,30 +20,82 @@ from flask import jsonify
 from cors import crossdomain
 import sqlite3
 
+from sshpool import SSHPool
+from requirements_cache import RequirementsCache
+from jobs import JobEngine
+from jobstore import JobStore
+from db import database
+from registry_cache import registry_cache
+from discovery import Discovery
+from relay_balancer import RelayBalancer
+from analysis_scheduler import AnalysisScheduler
+from metrics import Metrics
+from events import EventLog
+from admission import Admission
+
 from relay import *
 
 class Tracevisor:
-    THREAD_STARTED = 1
-    THREAD_TRACE_RUNNING = 2
-    THREAD_ANALYSIS_RUNNING = 3
-    THREAD_COMPLETE = 4
-    THREAD_ERROR = -1
+    JOB_QUEUED = "queued"
+    JOB_SETUP = "setup"
+    JOB_TRACING = "tracing"
+    JOB_ANALYSING = "analysing"
+    JOB_DONE = "done"
+    JOB_ERROR = "error"
+    JOB_CANCELLED = "cancelled"
     # Temporarily hardcoded
     PATH_ANALYSES = "/usr/local/src/lttng-analyses/"
     PATH_TRACES = "/root/lttng-traces/"
-    DBVERSION = 2
+    DBVERSION = 8
+    # channel settings of the analyses: lttng enable-channel option and
+    # accepted values
+    CHANNEL_OPTIONS = {
+            "subbuf_size": ("--subbuf-size", r"^[0-9]+[kMG]?$"),
+            "num_subbuf": ("--num-subbuf", r"^[0-9]+$"),
+            "switch_timer": ("--switch-timer", r"^[0-9]+$"),
+            "read_timer": ("--read-timer", r"^[0-9]+$"),
+            "output": ("--output", r"^(mmap|splice)$"),
+            }
+    CHANNEL_NAME = "tracevisor"
+    # accepted range of the integer fields of the requests and registries
+    PORT_RANGE = (1, 65535)
+    # oldest schema that can be migrated in place
+    DBVERSION_MIGRATE = 2
 
     def __init__(self):
         self.default_relay = "127.0.0.1"
         self.default_mongohost = "127.0.0.1"
         self.default_mongoport = 27017
         self.ssh = "ssh -oBatchMode=yes -oStrictHostKeyChecking=no -i ~/.ssh/id_rsa_tracevisor"
+        self.default_sshport = 22
+        # idle time in seconds before a multiplexed ssh connection is closed
+        self.ssh_idle_timeout = 300
+        # seconds before a remote command is killed, the analyses and the
+        # transfers of the traces get analysis_timeout seconds
+        self.command_timeout = 60
+        self.analysis_timeout = 3600
+        self.sshpool = SSHPool(self.ssh, self.ssh_idle_timeout,
+                timeout=self.command_timeout)
+        # group the preflight checks and the session setup in one ssh
+        # round-trip each instead of one per command
+        self.batch_remote = True
+        # seconds during which the preflight checks of a host/user are cached
+        self.requirements_ttl = 60
+        self.requirements_cache = RequirementsCache(self.requirements_ttl)
+
+        # live mode: flush period of the sessions in microseconds, number of
+        # output lines of a live analysis kept on the job, and the new lines
+        # are published at most every output_interval seconds
+        self.live_timer = 1000000
+        self.max_output_lines = 100
+        self.output_interval = 1
 
         self.analyses = {}
 
         self.analyses["cpu"] = {}
         self.analyses["cpu"]["kernel_events"] = "sched_switch,sched_process_fork,sched_process_exec," \
                 "lttng_statedump_process_state"
+        self.analyses["cpu"]["channel"] = {"subbuf_size": "1M", "num_subbuf": 4}
 
         self.analyses["io"] = {}
         self.analyses["io"]["kernel_events"] = "sched_switch,block_rq_complete,block_rq_issue," \
@@ -45,20 +104,357 @@ class Tracevisor:
                 "lttng_statedump_process_state,lttng_statedump_file_descriptor," \
                 "lttng_statedump_block_device"
         self.analyses["io"]["syscalls"] = True
+        # all the syscalls on busy hosts, larger buffers drained more often
+        self.analyses["io"]["channel"] = {"subbuf_size": "2M", "num_subbuf": 8,
+                "read_timer": 100000}
         self.analyses["io"]["script"] = "fd-info.py"
         self.analyses["io"]["args"] = "--quiet --mongo"
 
-        self.running_threads = {}
-        self.jobid = 0
+        # number of job phases running concurrently on the event loop, jobs
+        # waiting for the end of their tracing window do not hold a worker
+        self.max_workers = 64
+        self.engine = JobEngine(self.max_workers)
+        self.jobs = {}
+        # completed jobs, least recently used first, kept for at most
+        # history_ttl seconds
+        self.history = collections.OrderedDict()
+        self.max_history = 1000
+        self.history_ttl = 3600
+        # maximum number of jobs returned by one list request
+        self.max_list_limit = 100
+        self.jobs_lock = threading.Lock()
+        # the jobs are also stored in the database, so they survive a
+        # restart and several controllers can share it
+        self.controller_name = socket.gethostname()
+        self.jobstore = JobStore(database, self.controller_name)
+        # the job changes pushed to the clients, the last max_events are kept
+        # for the clients reconnecting, with a keepalive every
+        # events_keepalive seconds on idle streams
+        self.max_events = 1000
+        self.events_keepalive = 15
+        self.events = EventLog(self.max_events)
+        self.engine.periodic(60, self.reap_history)
+        self.engine.periodic(30, self.evict_ssh)
+        # hosts announcing _lttng._tcp, browsed in the background
+        self.discovery = Discovery()
+        self.discovery.start()
+        # placement of the sessions on the registered relays
+        self.relay_balancer = RelayBalancer()
+        # tracing sessions at the same time on a host, streaming to a relay
+        # (on top of its maxsessions) and in total, 0 for no limit, the jobs
+        # over the limits are rejected with a retry hint, or queued up to
+        # max_admission_queue jobs if requested, admission_retry is the hint
+        # when no job is expected to end
+        self.max_host_sessions = 1
+        self.max_relay_sessions = 0
+        self.max_sessions = 0
+        self.max_admission_queue = 100
+        self.admission_retry = 5
+        self.admission = Admission(self.max_host_sessions, self.max_relay_sessions,
+                self.max_sessions, self.max_admission_queue)
+        # latency of the job phases and remote steps, by phase and analysis
+        # type, and by host without the buckets
+        self.metrics = Metrics()
+        self.metrics.describe("tracevisor_phase_seconds", "histogram",
+                "Duration of the job phases and remote steps")
+        self.metrics.describe("tracevisor_host_phase_seconds", "summary",
+                "Duration of the job phases and remote steps per host")
+        self.metrics.describe("tracevisor_phase_errors_total", "counter",
+                "Failed job phases and remote steps")
+        self.metrics.describe("tracevisor_job_seconds", "histogram",
+                "Duration of the jobs, from the request to the last analysis")
+        self.metrics.describe("tracevisor_admission_rejected_total", "counter",
+                "Jobs rejected by the admission limits")
         self.relay = Relay()
-        self.client = Client()
+        self.client = Client(self.requirements_cache)
         self.analyses_servers = AnalysesServers()
+        # the analyses queued for the registered analysis servers, also
+        # dispatched periodically to catch the changes of the servers, the
+        # analyses on the relays or on the requested hosts run at most
+        # max_local_analyses at a time (0 for no limit)
+        self.max_local_analyses = 8
+        self.analysis_scheduler = AnalysisScheduler(self.engine.loop,
+                self.analyses_servers.get_servers, self.run_analysis,
+                self.max_local_analyses)
+        self.engine.periodic(5, self.analysis_scheduler.dispatch)
+
+    @property
+    def con(self):
+        # connection taken from the pool by the current thread
+        return database.connection()
 
     def connect_db(self):
-        self.con = sqlite3.connect("config.db")
+        database.acquire()
 
     def disconnect_db(self):
-        self.con.close()
+        database.release()
+
+    def json_response(self, body, modified=None):
+        # JSON response supporting the conditional requests, a client with
+        # an up to date copy (If-None-Match/If-Modified-Since) gets a 304
+        resp = Response(body, mimetype="application/json")
+        resp.set_etag(hashlib.sha1(body.encode()).hexdigest())
+        if modified is not None:
+            resp.last_modified = modified
+        return resp.make_conditional(request)
+
+    def registry_response(self, entry, extra=None):
+        if extra:
+            return self.json_response(json.dumps(entry["rows"] + extra),
+                    entry["modified"])
+        resp = Response(entry["body"], mimetype="application/json")
+        resp.set_etag(entry["etag"])
+        resp.last_modified = entry["modified"]
+        return resp.make_conditional(request)
+
+    def registry_get(self, table, rq_to, load, row_id):
+        # one row of a registry table, from memory if the table is cached
+        entry = registry_cache.get(table, load)
+        if entry is not None:
+            for r in entry["rows"]:
+                if r["id"] == row_id:
+                    return r
+            return None
+        self.connect_db()
+        cur = self.con.cursor()
+        cur.execute("SELECT * FROM %s WHERE id=:id" % table, {"id": row_id})
+        rq = cur.fetchall()
+        self.disconnect_db()
+        if rq:
+            return rq_to(rq[0])
+        return None
+
+    def stream_response(self, chunks, mimetype, headers=None):
+        # response sent as the chunks are generated, compressed on the fly
+        # if the client accepts gzip
+        if request.accept_encodings["gzip"]:
+            resp = Response(self.gzip_chunks(chunks), mimetype=mimetype)
+            resp.headers["Content-Encoding"] = "gzip"
+        else:
+            resp = Response(chunks, mimetype=mimetype)
+        resp.vary.add("Accept-Encoding")
+        if headers:
+            resp.headers.update(headers)
+        return resp
+
+    def gzip_chunks(self, chunks):
+        z = zlib.compressobj(6, zlib.DEFLATED, 31)
+        for c in chunks:
+            data = z.compress(c.encode())
+            if data:
+                yield data
+        yield z.flush()
+
+    def listing_query(self, table):
+        # the filters of a registry listing as a WHERE clause, the rows with
+        # a hostname starting with "hostname" and after the "cursor" ID
+        where = []
+        args = {}
+        prefix = request.args.get("hostname")
+        if prefix:
+            # a range on the hostname index
+            where.append("hostname>=:prefix AND hostname<:prefix_end")
+            args["prefix"] = prefix
+            args["prefix_end"] = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        if "cursor" in request.args:
+            where.append("id>:cursor")
+            args["cursor"] = int(request.args["cursor"])
+        query = "FROM %s" % table
+        if where:
+            query += " WHERE " + " AND ".join(where)
+        return (query, args)
+
+    def registry_listing(self, table, rq_to, load, extra=None):
+        # the small tables are served from memory, the pages, the filtered
+        # listings and the large tables are streamed from the database,
+        # "extra" rows are appended unless their hostname is registered
+        if extra is None:
+            extra = []
+        paged = False
+        for a in ["limit", "cursor", "hostname"]:
+            if a in request.args:
+                paged = True
+        if not paged:
+            entry = registry_cache.get(table, load)
+            if entry is not None:
+                registered = set([r["hostname"] for r in entry["rows"]])
+                return self.registry_response(entry,
+                        [e for e in extra if not e["hostname"] in registered])
+
+        try:
+            (query, args) = self.listing_query(table)
+            limit = None
+            if "limit" in request.args:
+                limit = int(request.args["limit"])
+                if limit < 1:
+                    raise ValueError
+        except ValueError:
+            return "Invalid cursor or limit\n", 400
+
+        headers = {}
+        last_page = True
+        self.connect_db()
+        cur = self.con.cursor()
+        if limit is not None:
+            # the last row of the page is the next cursor, if there is
+            # anything after it
+            cur.execute("SELECT id %s ORDER BY id LIMIT 2 OFFSET :offset" % query,
+                    dict(args, offset=limit - 1))
+            r = cur.fetchall()
+            if len(r) == 2:
+                headers["X-Next-Cursor"] = str(r[0][0])
+                last_page = False
+        # the extra rows come with the last page
+        prefix = request.args.get("hostname", "")
+        extra = [e for e in extra if e["hostname"].startswith(prefix)]
+        if extra and last_page:
+            names = [e["hostname"] for e in extra]
+            cur.execute("SELECT hostname FROM %s WHERE hostname IN (%s)" % \
+                    (table, ",".join(["?"] * len(names))), names)
+            registered = set([r[0] for r in cur.fetchall()])
+            extra = [e for e in extra if not e["hostname"] in registered]
+        else:
+            extra = []
+
+        def generate():
+            cur = self.con.cursor()
+            try:
+                if limit is None:
+                    cur.execute("SELECT * %s ORDER BY id" % query, args)
+                else:
+                    cur.execute("SELECT * %s ORDER BY id LIMIT :limit" % query,
+                            dict(args, limit=limit))
+                sep = ""
+                yield "["
+                while True:
+                    r = cur.fetchmany(500)
+                    if not r:
+                        break
+                    yield sep + ", ".join([json.dumps(rq_to(i)) for i in r])
+                    sep = ", "
+                for e in extra:
+                    yield sep + json.dumps(e)
+                    sep = ", "
+                yield "]"
+            finally:
+                cur.close()
+                self.disconnect_db()
+        return self.stream_response(generate(), "application/json", headers)
+
+    def invalid_int(self, values, ranges):
+        # the first field of values that is not an integer in its range of
+        # ranges (name -> (min, max)), or None
+        for (k, (low, high)) in ranges.items():
+            if not k in values:
+                continue
+            v = values[k]
+            if isinstance(v, bool) or not isinstance(v, int) or v < low or v > high:
+                return k
+        return None
+
+    def upsert(self, cur, table, fields, update):
+        # insert the row, or update the "update" columns of the row with the
+        # same hostname, in one statement, returns the row ID
+        columns = list(fields.keys())
+        sets = []
+        for c in columns:
+            if c in update and c != "hostname":
+                sets.append("%s=excluded.%s" % (c, c))
+        if not sets:
+            # a no-op update, to get the ID of the existing row back
+            sets.append("hostname=excluded.hostname")
+        cur.execute("INSERT INTO %s (%s) VALUES(%s) ON CONFLICT(hostname) "
+                "DO UPDATE SET %s RETURNING id" % (table, ", ".join(columns),
+                    ", ".join([":" + c for c in columns]), ", ".join(sets)),
+                fields)
+        return cur.fetchone()[0]
+
+    def bulk_rows(self):
+        # the rows of a bulk request: a JSON array, or one JSON object per
+        # line (NDJSON) read as it comes, an invalid row is None
+        if request.mimetype == "application/json":
+            rows = request.get_json(silent=True)
+            if not isinstance(rows, list):
+                return None
+            return rows
+        return self.ndjson_rows()
+
+    def ndjson_rows(self):
+        for line in request.stream:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line.decode())
+            except ValueError:
+                yield None
+
+    def bulk_import(self, table, defaults, ranges=None):
+        rows = self.bulk_rows()
+        if rows is None:
+            return "Expecting a JSON array or NDJSON\n", 400
+
+        # all the rows in one transaction, the upsert statements are
+        # prepared once per set of fields
+        results = []
+        imported = 0
+        self.connect_db()
+        with self.con:
+            cur = self.con.cursor()
+            for (i, row) in enumerate(rows):
+                res = {}
+                res["row"] = i
+                if not isinstance(row, dict):
+                    res["error"] = "Invalid JSON object"
+                    results.append(res)
+                    continue
+                if not "hostname" in row:
+                    res["error"] = "Missing hostname"
+                    results.append(res)
+                    continue
+                res["hostname"] = row["hostname"]
+                if not "ipv4" in row and not "ipv6" in row:
+                    res["error"] = "Missing IPv4 or IPv6 address"
+                    results.append(res)
+                    continue
+                bad = self.invalid_int(row, ranges or {})
+                if bad is not None:
+                    res["error"] = "Invalid %s" % bad
+                    results.append(res)
+                    continue
+                fields = dict(defaults)
+                fields["hostname"] = row["hostname"]
+                for k in defaults.keys():
+                    if k in row:
+                        fields[k] = row[k]
+                try:
+                    res["id"] = self.upsert(cur, table, fields, row.keys())
+                    imported += 1
+                except sqlite3.Error as e:
+                    res["error"] = str(e)
+                results.append(res)
+        self.disconnect_db()
+        ret = {}
+        ret["imported"] = imported
+        ret["errors"] = len(results) - imported
+        ret["results"] = results
+        return Response(json.dumps(ret), mimetype="application/json")
+
+    def export_table(self, table, rq_to):
+        # one JSON object per line, streamed as the rows are read
+        def generate():
+            cur = self.con.cursor()
+            try:
+                cur.execute("SELECT * FROM %s ORDER BY id" % table)
+                while True:
+                    r = cur.fetchmany(500)
+                    if not r:
+                        break
+                    yield "".join([json.dumps(rq_to(i)) + "\n" for i in r])
+            finally:
+                cur.close()
+                self.disconnect_db()
+        return self.stream_response(generate(), "application/x-ndjson")
 
     def drop_all_tables(self, cur):
         try:
@@ -77,6 +473,49 @@ class Tracevisor:
             cur.execute("DROP TABLE analyses")
         except sqlite3.OperationalError:
             pass
+        try:
+            cur.execute("DROP TABLE jobs")
+        except sqlite3.OperationalError:
+            pass
+        try:
+            cur.execute("DROP TABLE job_hosts")
+        except sqlite3.OperationalError:
+            pass
+
+    def migrate_db(self, cur, version):
+        # upgrade the schema in place, without losing the registered hosts
+        if version < 3:
+            try:
+                cur.execute("ALTER TABLE clients ADD COLUMN groupname TEXT DEFAULT ''")
+            except sqlite3.OperationalError:
+                pass
+        # version 4 added the jobs tables, created below if missing
+        if version < 5:
+            # the unique hostname indexes require to drop the duplicates,
+            # keep the most recent entry
+            for table in ["relays", "clients", "analyses"]:
+                try:
+                    cur.execute("DELETE FROM %s WHERE id NOT IN "
+                            "(SELECT MAX(id) FROM %s GROUP BY hostname)" % (table, table))
+                except sqlite3.OperationalError:
+                    pass
+        if version < 6:
+            try:
+                cur.execute("ALTER TABLE relays ADD COLUMN maxsessions INT DEFAULT 0")
+            except sqlite3.OperationalError:
+                pass
+        if version < 7:
+            try:
+                cur.execute("ALTER TABLE analyses ADD COLUMN maxjobs INT DEFAULT 4")
+            except sqlite3.OperationalError:
+                pass
+        if version < 8:
+            try:
+                cur.execute("ALTER TABLE relays ADD COLUMN sshuser TEXT DEFAULT 'root'")
+                cur.execute("ALTER TABLE relays ADD COLUMN sshport INT DEFAULT 22")
+            except sqlite3.OperationalError:
+                pass
+        cur.execute("UPDATE schema SET version=:version", {"version": self.DBVERSION})
 
     def check_db(self):
         self.connect_db()
@@ -91,32 +530,50 @@ class Tracevisor:
                 cur.execute("INSERT INTO schema VALUES(:version)", ({"version": self.DBVERSION}))
             r = cur.fetchall()
             if r:
-                if r[0][0] != self.DBVERSION:
+                if r[0][0] < self.DBVERSION_MIGRATE or r[0][0] > self.DBVERSION:
                     print("Different DB version, resetting the database")
                     self.drop_all_tables(cur)
                     cur.execute("CREATE TABLE schema (version INT)")
                     cur.execute("INSERT INTO schema VALUES(:version)", ({"version": self.DBVERSION}))
+                elif r[0][0] != self.DBVERSION:
+                    print("Migrating the database from version %d to %d" % \
+                            (r[0][0], self.DBVERSION))
+                    self.migrate_db(cur, r[0][0])
 
             try:
                 cur.execute("select * from relays")
             except sqlite3.OperationalError:
                 print("Creating \"relays\" table")
                 cur.execute("CREATE TABLE relays (id INTEGER PRIMARY KEY, hostname TEXT, ipv4 TEXT,"
-                    "ipv6 TEXT, ctrlport INT, dataport INT)")
+                    "ipv6 TEXT, ctrlport INT, dataport INT, maxsessions INT, sshuser TEXT, "
+                    "sshport INT)")
 
             try:
                 cur.execute("select * from clients")
             except sqlite3.OperationalError:
                 print("Creating \"clients\" table")
                 cur.execute("CREATE TABLE clients (id INTEGER PRIMARY KEY, hostname TEXT, "
-                    "ipv4 TEXT, ipv6 TEXT, sshport INT, sshuser TEXT)")
+                    "ipv4 TEXT, ipv6 TEXT, sshport INT, sshuser TEXT, groupname TEXT)")
 
             try:
                 cur.execute("select * from analyses")
             except sqlite3.OperationalError:
                 print("Creating \"analyses\" table")
                 cur.execute("CREATE TABLE analyses (id INTEGER PRIMARY KEY, hostname TEXT, "
-                    "ipv4 TEXT, ipv6 TEXT, sshport INT, sshuser TEXT)")
+                    "ipv4 TEXT, ipv6 TEXT, sshport INT, sshuser TEXT, maxjobs INT)")
+
+            try:
+                cur.execute("select * from jobs")
+            except sqlite3.OperationalError:
+                print("Creating \"jobs\" table")
+                self.jobstore.create_tables(cur)
+
+            # one row per hostname in the registries
+            for table in ["relays", "clients", "analyses"]:
+                cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS %s_hostname ON %s (hostname)" \
+                        % (table, table))
+            # the group lookups of the large fleets
+            cur.execute("CREATE INDEX IF NOT EXISTS clients_groupname ON clients (groupname)")
         self.disconnect_db()
 
     def get_analyses(self):
@@ -124,10 +581,92 @@ class Tracevisor:
 
         for k in self.analyses:
             analysesList.append({
-                "analysis": k
+                "analysis": k,
+                "channel": self.analyses[k].get("channel", {})
             })
         return Response(json.dumps(analysesList), mimetype="application/json")
 
+    def get_sshpool_stats(self):
+        return jsonify(self.sshpool.stats())
+
+    def get_events(self):
+        # Server-Sent Events, one "job" event with the job details at each
+        # status change and host completion, from the Last-Event-ID of a
+        # reconnecting client or the cursor of the list request, a "reset"
+        # event when the client has to reload the list
+        cursor = request.headers.get("Last-Event-ID", request.args.get("cursor"))
+        if cursor is None:
+            cursor = self.events.cursor()
+        else:
+            try:
+                cursor = int(cursor)
+            except ValueError:
+                return "Invalid cursor\n", 400
+        return Response(self.event_stream(cursor), mimetype="text/event-stream",
+                headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+    def event_stream(self, cursor):
+        yield "retry: 2000\n\n"
+        while True:
+            (seq, events) = self.events.since(cursor, self.events_keepalive)
+            if events is None:
+                yield "id: %d\nevent: reset\ndata: {}\n\n" % seq
+            elif not events:
+                # also detects the disconnected clients
+                yield ": keepalive\n\n"
+            else:
+                yield "".join(["id: %d\nevent: %s\ndata: %s\n\n" % e for e in events])
+            cursor = seq
+
+    def get_metrics(self):
+        # the gauges are read at scrape time, the jobs in the history are done
+        gauges = []
+        statuses = {}
+        sessions = 0
+        self.jobs_lock.acquire()
+        for task in self.jobs.values():
+            statuses[task["status"]] = statuses.get(task["status"], 0) + 1
+            if task["status"] in [self.JOB_SETUP, self.JOB_TRACING]:
+                sessions += len(task["targets"])
+        self.jobs_lock.release()
+        gauges.append(("tracevisor_jobs", "Jobs in progress by status",
+            [({"status": k}, v) for (k, v) in sorted(statuses.items())]))
+        gauges.append(("tracevisor_active_sessions",
+            "Tracing sessions being set up or recording", [({}, sessions)]))
+        e = self.engine.stats()
+        gauges.append(("tracevisor_engine_jobs", "Jobs of the job engine",
+            [({"state": k}, e[k]) for k in ["busy", "queued", "waiting"]]))
+        s = self.admission.stats()
+        gauges.append(("tracevisor_admission_queue",
+            "Jobs waiting for the admission limits", [({}, s["queued"])]))
+        a = self.analysis_scheduler.stats()
+        gauges.append(("tracevisor_analysis_queue",
+            "Analyses waiting for an analysis server", [({}, a["queued"])]))
+        gauges.append(("tracevisor_analyses_running",
+            "Analyses running per analysis server",
+            [({"server": k}, v) for (k, v) in sorted(a["running"].items())] +
+            [({"server": "local"}, a["local_running"])]))
+        r = sorted(self.relay_balancer.stats().items())
+        gauges.append(("tracevisor_relay_sessions", "Active sessions per relay",
+            [({"relay": k}, v["sessions"]) for (k, v) in r]))
+        gauges.append(("tracevisor_relay_throughput_bytes",
+            "Recent throughput of the traces per relay",
+            [({"relay": k}, v["throughput"]) for (k, v) in r]))
+        p = self.sshpool.stats()
+        gauges.append(("tracevisor_ssh_channels", "Open SSH master connections",
+            [({}, p["channels"])]))
+        counters = []
+        for (k, help) in [
+                ("hits", "SSH commands run on an open master connection"),
+                ("misses", "SSH commands that opened a master connection"),
+                ("evictions", "Idle SSH master connections closed"),
+                ("failures", "SSH commands failed"),
+                ("connection_failures", "SSH commands failed to connect"),
+                ("timeouts", "SSH commands killed after their timeout")]:
+            counters.append(("tracevisor_ssh_%s_total" % k, help, [({}, p[k])]))
+        return Response(self.metrics.render(gauges, counters),
+                mimetype="text/plain; version=0.0.4")
+
     def get_ssh_keys(self):
         path = os.path.join(os.environ["HOME"], ".ssh")
         l = os.listdir(path)
@@ -139,202 +678,1041 @@ class Tracevisor:
         return jsonify({ 'keys': keys })
 
     def get_server_list(self):
-        server_list = []
-        servers = {}
-        # get the list from the database
-        registered_clients = tracevisor.client.get_clients_list()
-        for i in registered_clients:
-            servers[i["hostname"]] = i
-
-        # get the list from DNS-SD
+        # the registered clients, and the hosts discovered with DNS-SD
+        return self.client.get_clients_list(self.discovery.get_servers())
+
+    async def run_steps(self, username, host, port, steps, outputs, timings=None,
+            procs=None):
+        # Run a list of (name, command, error) steps on the remote host, stop
+        # at the first failure and return its error. The output of each step
+        # is stored in outputs[name], its duration in timings[name].
+        if timings is None:
+            timings = {}
+        if not self.batch_remote:
+            for (name, cmd, error) in steps:
+                start = time.time()
+                try:
+                    ret = await self.sshpool.run_async(username, host, cmd, port,
+                            procs=procs)
+                except subprocess.CalledProcessError:
+                    return error, 503
+                finally:
+                    timings[name] = time.time() - start
+                outputs[name] = ret.decode()
+            return 0
+
+        # batch mode: send all the steps as one script on stdin, each step
+        # output is delimited by markers so we know which one failed, the
+        # markers carry the remote time to measure each step
+        script = ""
+        for (name, cmd, error) in steps:
+            script += "echo \"<<<%s $(date +%%s.%%N)\"\n" % name
+            script += "%s || exit 1\n" % cmd
+            script += "echo \">>>%s $(date +%%s.%%N)\"\n" % name
         try:
-            ret = subprocess.check_output("avahi-browse _lttng._tcp -p -t -r", shell=True)
-        except subprocess.CalledProcessError:
-            return "Error running avahi-browse _lttng._tcp -p -t", 503
-
-        lines = str(ret, encoding='utf8').split("\n")
-        for entry in lines:
-            l = entry.split(";")
-            # only output "resolved" entries
-            if l[0] != "=":
-                continue
-            # avoid duplicates based on the hostname
-            if l[3] in servers.keys():
-                continue
-            d = {}
-            d["hostname"] = l[3]
-            if l[2] == "IPv4":
-                d["ipv4"] = l[7]
-            elif l[2] == "IPv6":
-                d["ipv6"] = l[7]
-            # the auto-discovered clients cannot be accessed with the REST URL
-            d["id"] = -1
-            servers[d["hostname"]] = d
-
-        for i in servers.keys():
-            server_list.append(servers[i])
-        return Response(json.dumps(server_list), mimetype="application/json")
-
-    def check_requirements(self, host, username):
+            ret = await self.sshpool.run_async(username, host, "sh -s", port,
+                    input=script.encode(), procs=procs)
+            failed = False
+        except subprocess.CalledProcessError as e:
+            ret = e.output
+            failed = True
+
+        current = None
+        done = []
+        started = {}
+        for line in ret.decode().splitlines():
+            if line.startswith("<<<"):
+                l = line[3:].split(" ")
+                current = l[0]
+                outputs[current] = ""
+                started[current] = l[-1]
+            elif line.startswith(">>>"):
+                l = line[3:].split(" ")
+                done.append(l[0])
+                current = None
+                try:
+                    timings[l[0]] = float(l[-1]) - float(started[l[0]])
+                except (ValueError, KeyError):
+                    # no sub-second date on the remote host
+                    pass
+            elif current is not None:
+                outputs[current] += line + "\n"
+        if not failed:
+            return 0
+        # the failed step is the first one not completed, if the ssh
+        # connection itself failed, this is the first step
+        for (name, cmd, error) in steps:
+            if not name in done:
+                return error, 503
+        return steps[-1][2], 503
+
+    async def check_requirements(self, host, username, port=22, results=None):
+        steps = []
         # check SSH connection
-        try:
-            ret = subprocess.check_output("%s %s@%s id" \
-                    % (self.ssh, username, host), shell=True)
-        except subprocess.CalledProcessError:
-            return "Cannot establish an ssh connection : %s %s@%s failed\n" \
-                    % (self.ssh, username, host), 503
-
+        steps.append(("ssh", "id",
+            "Cannot establish an ssh connection : %s -p %d %s@%s failed\n" \
+                    % (self.ssh, port, username, host)))
         # check for a root sessiond
-        try:
-            ret = subprocess.check_output("%s %s@%s pgrep -u root lttng-sessiond" \
-                    % (self.ssh, username, host), shell=True)
-        except subprocess.CalledProcessError:
-            return "Root lttng-sessiond not started\n", 503
-
+        steps.append(("sessiond", "pgrep -u root lttng-sessiond",
+            "Root lttng-sessiond not started\n"))
         # check tracing group or root
         if username != "root":
-            try:
-                ret = subprocess.check_output("%s %s@%s groups|grep tracing" \
-                        % (self.ssh, username, host), shell=True)
-            except subprocess.CalledProcessError:
-                return "User not in tracing group", 503
+            steps.append(("tracing", "groups|grep tracing",
+                "User not in tracing group"))
+        # in batch mode, the target hostname comes for free
+        if self.batch_remote:
+            steps.append(("hostname", "hostname -s",
+                "Failed to get the hostname\n"))
+
+        outputs = {}
+        ret = await self.run_steps(username, host, port, steps, outputs)
+        if ret != 0:
+            return ret
+        if results is not None and "hostname" in outputs:
+            results["hostname"] = outputs["hostname"].strip()
         return 0
 
-    def launch_trace(self, host, username, relay, type, duration, task):
-        task["session_name"] = "%s-%s-%s-%s" % (appname, type,
-                str(int(time.time())), task["jobid"])
-        # get the target hostname
-        try:
-            ret = subprocess.check_output("%s %s@%s hostname -s" \
-                    % (self.ssh, username, host), shell=True)
-        except subprocess.CalledProcessError:
-            return "Failed to get the hostname\n", 503
-        hostname = ret.decode().strip()
+    async def preflight(self, target, type):
+        # check_requirements for one target, through the cache
+        host = target["host"]
+        username = target["username"]
+        cached = self.requirements_cache.get(host, username)
+        if cached is not None:
+            target.update(cached)
+            return 0
+        checked = {}
+        start = time.time()
+        ret = await self.check_requirements(host, username, target["sshport"],
+                checked)
+        self.observe(type, target, "preflight", time.time() - start, ret)
+        if ret != 0:
+            return ret
+        self.requirements_cache.set(host, username, checked)
+        target.update(checked)
+        return 0
 
-        # create the session
-        try:
-            ret = subprocess.check_output("%s %s@%s lttng create %s -U %s" \
-                    % (self.ssh, username, host, task["session_name"],
-                        "net://%s" % relay), shell=True)
-        except subprocess.CalledProcessError:
-            return "Session creation error\n", 503
+    async def preflight_targets(self, targets, type):
+        rets = await asyncio.gather(*[self.preflight(t, type) for t in targets])
+        return self.targets_error(targets, rets)
+
+    def observe(self, type, target, phase, seconds, ret=0):
+        # record the duration of a phase or remote step of a target
+        if not "timings" in target.keys():
+            target["timings"] = {}
+        target["timings"][phase] = round(seconds, 3)
+        self.metrics.observe("tracevisor_phase_seconds",
+                {"phase": phase, "type": type}, seconds)
+        self.metrics.observe("tracevisor_host_phase_seconds",
+                {"phase": phase, "host": target["host"]}, seconds)
+        if ret != 0:
+            self.metrics.inc("tracevisor_phase_errors_total",
+                    {"phase": phase, "type": type})
+
+    def targets_error(self, targets, rets):
+        # record the error of each target and return the first one, prefixed
+        # by the host when the job has several targets
+        ret = 0
+        for (t, r) in zip(targets, rets):
+            if r == 0:
+                continue
+            t["error"] = r[0]
+            if ret != 0:
+                continue
+            if len(targets) == 1:
+                ret = r
+            else:
+                ret = "%s: %s" % (t["host"], r[0]), r[1]
+        return ret
+
+    def channel_config(self, type):
+        # the channel settings of the analysis, overridden by the "channel"
+        # of the request, returns None if a setting is invalid
+        channel = dict(self.analyses[type].get("channel", {}))
+        if 'channel' in request.json:
+            if not isinstance(request.json["channel"], dict):
+                return None
+            channel.update(request.json["channel"])
+        for (k, v) in channel.items():
+            if not k in self.CHANNEL_OPTIONS.keys():
+                return None
+            if isinstance(v, bool) or \
+                    not re.match(self.CHANNEL_OPTIONS[k][1], str(v)):
+                return None
+        return channel
+
+    def channel_steps(self, session_name, mode, channel):
+        # a kernel channel with the settings of the analysis (the kernel
+        # buffers are always per-CPU), a snapshot session overwrites the
+        # oldest events in its ring buffers and requires mmap buffers
+        if not channel and mode != "snapshot":
+            return []
+        if mode == "snapshot":
+            channel = dict(channel, output="mmap")
+        options = []
+        for k in sorted(channel.keys()):
+            options.append("%s=%s" % (self.CHANNEL_OPTIONS[k][0], channel[k]))
+        if mode == "snapshot":
+            options.append("--overwrite")
+        return [("channel", "lttng enable-channel -s %s -k %s %s" \
+                % (session_name, " ".join(options), self.CHANNEL_NAME),
+            "Channel configuration failed\n")]
+
+    def setup_steps(self, type, session_name, relay, mode="trace", channel=None):
+        steps = []
+        # create the session, a live session can be read from the relay
+        # while it runs
+        if mode == "live":
+            steps.append(("create", "lttng create %s --live=%d -U %s" \
+                    % (session_name, self.live_timer, "net://%s" % relay),
+                "Session creation error\n"))
+        elif mode == "snapshot":
+            # in-memory ring buffers, the output is only used by the snapshots
+            steps.append(("create", "lttng create %s --snapshot -U %s" \
+                    % (session_name, "net://%s" % relay),
+                "Session creation error\n"))
+        else:
+            steps.append(("create", "lttng create %s -U %s" \
+                    % (session_name, "net://%s" % relay),
+                "Session creation error\n"))
+        kchannel = ""
+        if channel is not None:
+            channel_steps = self.channel_steps(session_name, mode, channel)
+            if channel_steps:
+                steps += channel_steps
+                kchannel = " -c %s" % self.CHANNEL_NAME
         # enable events
-        events = ""
         if "kernel_events" in self.analyses[type].keys() and \
                 len(self.analyses[type]["kernel_events"]) > 0:
-            try:
-                ret = subprocess.check_output("%s %s@%s lttng enable-event -s %s -k %s" \
-                        % (self.ssh, username, host, task["session_name"],
-                            self.analyses[type]["kernel_events"]), shell=True)
-            except subprocess.CalledProcessError:
-                return "Enabling kernel events failed\n", 503
+            steps.append(("kernel_events", "lttng enable-event -s %s -k%s %s" \
+                    % (session_name, kchannel, self.analyses[type]["kernel_events"]),
+                "Enabling kernel events failed\n"))
 
         if "syscalls" in self.analyses[type].keys():
-            try:
-                ret = subprocess.check_output("%s %s@%s lttng enable-event -s %s -k --syscall -a" \
-                        % (self.ssh, username, host, task["session_name"]), shell=True)
-            except subprocess.CalledProcessError:
-                return "Enabling syscalls failed\n", 503
+            steps.append(("syscalls", "lttng enable-event -s %s -k%s --syscall -a" \
+                    % (session_name, kchannel),
+                "Enabling syscalls failed\n"))
 
         if "userspace_events" in self.analyses[type].keys() and \
                 len(self.analyses[type]["userspace_events"]) > 0:
-            try:
-                ret = subprocess.check_output("%s %s@%s lttng enable-event -s %s -k %s" \
-                        % (self.ssh, username, host, task["session_name"],
-                            self.analyses[type]["userspace_events"]), shell=True)
-            except subprocess.CalledProcessError:
-                return "Enabling userspace events failed\n", 503
+            steps.append(("userspace_events", "lttng enable-event -s %s -k %s" \
+                    % (session_name, self.analyses[type]["userspace_events"]),
+                "Enabling userspace events failed\n"))
+        return steps
 
+    def set_status(self, task, status):
         task["lock"].acquire()
-        task["status"] = self.THREAD_TRACE_RUNNING
+        task["status"] = status
+        task["lock"].release()
+        self.update_job(task)
+
+    def update_job(self, task):
+        # store the job and push it to the clients following the jobs
+        # written in the background, a locked database must not stop the job
+        summary = self.job_summary(task)
+        self.jobstore.update(summary, self.events.cursor())
+        self.events.publish("job", summary)
+        return summary
+
+    def record_phase(self, task, phase, ret, duration=None):
+        p = {}
+        if ret != 0:
+            p["result"] = "error"
+            p["error"] = ret[0]
+        else:
+            p["result"] = "ok"
+        if duration is not None:
+            p["duration"] = round(duration, 3)
+        task["lock"].acquire()
+        task["phases"][phase] = p
         task["lock"].release()
 
-        # start the session
+    def finish_job(self, task, ret):
         try:
-            ret = subprocess.check_output("%s %s@%s lttng start %s" \
-                    % (self.ssh, username, host, task["session_name"]), shell=True)
+            self.complete_job(task, ret)
+        finally:
+            # the sessions and the job slot are freed in any case
+            for t in task["targets"]:
+                self.release_target(task, t)
+            # the history is reaped by the end time, even if completing failed
+            if not "finished" in task.keys():
+                task["finished"] = time.time()
+            self.jobs_lock.acquire()
+            self.jobs.pop(task["jobid"], None)
+            if not task["jobid"] in self.history.keys():
+                self.history[task["jobid"]] = self.job_summary(task)
+            while len(self.history) > self.max_history:
+                self.history.popitem(last=False)
+            self.jobs_lock.release()
+
+    def complete_job(self, task, ret):
+        if task["cancelled"]:
+            # the errors are the commands killed by the cancellation
+            task["lock"].acquire()
+            task["status"] = self.JOB_CANCELLED
+            task["lock"].release()
+        elif ret != 0:
+            for t in task["targets"]:
+                # the host may have changed since the preflight checks
+                if "error" in t.keys():
+                    self.requirements_cache.invalidate(t["host"], t["username"])
+            task["lock"].acquire()
+            task["error"] = ret[0]
+            task["status"] = self.JOB_ERROR
+            task["lock"].release()
+        else:
+            task["lock"].acquire()
+            task["status"] = self.JOB_DONE
+            task["lock"].release()
+        task["finished"] = time.time()
+        self.metrics.observe("tracevisor_job_seconds",
+                {"type": task["type"], "status": task["status"]},
+                task["finished"] - task["created"])
+
+        # move the job to the history right away
+        summary = self.update_job(task)
+        self.jobs_lock.acquire()
+        self.jobs.pop(task["jobid"], None)
+        self.history[task["jobid"]] = summary
+        self.jobs_lock.release()
+
+    def evict_ssh(self):
+        # close the idle ssh masters in the background
+        self.engine.loop.create_task(self.sshpool.evict_idle())
+
+    def reap_history(self):
+        # drop the jobs completed more than history_ttl seconds ago
+        limit = time.time() - self.history_ttl
+        self.jobs_lock.acquire()
+        for jobid in list(self.history.keys()):
+            if self.history[jobid].get("finished", 0) < limit:
+                del self.history[jobid]
+        self.jobs_lock.release()
+
+    async def launch_trace(self, task, target):
+        host = target["host"]
+        username = target["username"]
+        port = target["sshport"]
+        steps = []
+        # get the target hostname, unless the preflight already did
+        if not "hostname" in target.keys():
+            steps.append(("hostname", "hostname -s",
+                "Failed to get the hostname\n"))
+        steps += self.setup_steps(task["type"], task["session_name"], target["relay"],
+                task["mode"], task["channel"])
+        # in batch mode, start the session in the same round-trip, unless
+        # the start must be synchronized with other targets
+        start = self.batch_remote and len(task["targets"]) == 1
+        if start:
+            steps.append(("start", "lttng start %s" % (task["session_name"]),
+                "Session start error\n"))
+
+        outputs = {}
+        timings = {}
+        begin = time.time()
+        ret = await self.run_steps(username, host, port, steps, outputs, timings,
+                task["procs"])
+        self.observe(task["type"], target, "setup", time.time() - begin, ret)
+        for (name, seconds) in timings.items():
+            self.observe(task["type"], target, name, seconds)
+        if ret != 0:
+            return ret
+        if "hostname" in outputs:
+            target["hostname"] = outputs["hostname"].strip()
+        if start:
+            target["start_time"] = time.time()
+        return 0
+
+    async def start_trace(self, task, target):
+        sent = time.time()
+        try:
+            ret = await self.sshpool.run_async(target["username"], target["host"],
+                    "lttng start %s" % (task["session_name"]), target["sshport"],
+                    procs=task["procs"])
         except subprocess.CalledProcessError:
+            self.observe(task["type"], target, "start", time.time() - sent, 1)
             return "Session start error\n", 503
+        self.observe(task["type"], target, "start", time.time() - sent)
+        # the session started somewhere during the round-trip
+        target["start_time"] = (sent + time.time()) / 2
+        return 0
 
-        time.sleep(duration)
-
-        # stop the session
+    async def stop_trace(self, task, target):
+        host = target["host"]
+        username = target["username"]
+        port = target["sshport"]
+        # stop the session, this waits for the buffers to be flushed
+        start = time.time()
+        ret = 0
         try:
-            ret = subprocess.check_output("%s %s@%s lttng stop %s" \
-                    % (self.ssh, username, host, task["session_name"]), shell=True)
+            await self.sshpool.run_async(username, host, "lttng stop %s" \
+                    % (task["session_name"]), port)
         except subprocess.CalledProcessError:
-            return "Session stop error\n", 503
-        # destroy the session
+            ret = "Session stop error\n", 503
+        self.observe(task["type"], target, "stop", time.time() - start, ret)
+        # destroy the session even if it could not be stopped, to free its
+        # buffers
+        start = time.time()
         try:
-            ret = subprocess.check_output("%s %s@%s lttng destroy %s" \
-                    % (self.ssh, username, host, task["session_name"]), shell=True)
+            await self.sshpool.run_async(username, host, "lttng destroy %s" \
+                    % (task["session_name"]), port)
         except subprocess.CalledProcessError:
-            return "Session destroy error\n", 503
+            self.observe(task["type"], target, "destroy", time.time() - start, 1)
+            if ret == 0:
+                ret = "Session destroy error\n", 503
+            return ret
+        self.observe(task["type"], target, "destroy", time.time() - start)
+        return ret
 
-        task["lock"].acquire()
-        task["status"] = self.THREAD_ANALYSIS_RUNNING
-        task["lock"].release()
+    async def destroy_session(self, task, target):
+        # the session may not exist, or only partially
+        try:
+            await self.sshpool.run_async(target["username"], target["host"],
+                    "lttng destroy %s" % (task["session_name"]), target["sshport"])
+        except subprocess.CalledProcessError:
+            pass
 
-        ret = self.launch_analysis(task["analysis"], username,  hostname,
-                task["session_name"], type, task["mongohost"], task["mongoport"])
+    async def teardown(self, task):
+        # destroy the sessions left on all the targets after a failed or
+        # cancelled setup
+        await asyncio.gather(*[self.destroy_session(task, t) for t in task["targets"]])
+
+    async def setup_job(self, task):
+        # first phase: create the sessions on all the targets in parallel,
+        # start them together, then wait for the end of the tracing window
+        # in the scheduler
+        if task["cancelled"]:
+            self.finish_job(task, 0)
+            return
+        ret = 0
+        try:
+            self.set_status(task, self.JOB_SETUP)
+            ret = await self.setup_sessions(task)
+        except Exception as e:
+            ret = "Setup error: %s\n" % e, 503
+        if ret != 0 or task["cancelled"]:
+            try:
+                # some of the sessions may exist, with their buffers
+                await self.teardown(task)
+            finally:
+                self.finish_job(task, ret)
+            return
+
+        try:
+            self.set_status(task, self.JOB_TRACING)
+            targets = task["targets"]
+            if task["mode"] == "live":
+                # the analyses run during the tracing window, a target is
+                # done when both its session is stopped and its analysis is
+                # over
+                task["pending"] = 2 * len(targets)
+                for t in targets:
+                    self.dispatch_analysis(task, t)
+        finally:
+            # the sessions are stopped at the end of the window in any case,
+            # already on the loop, the timer exists before a cancellation
+            # runs
+            self.engine.add_timer(task["duration"], task, self.analysis_job)
+
+    async def setup_sessions(self, task):
+        targets = task["targets"]
+        start = time.time()
+        rets = await asyncio.gather(*[self.launch_trace(task, t) for t in targets])
+        ret = self.targets_error(targets, rets)
+        self.record_phase(task, "setup", ret, time.time() - start)
+        if ret != 0 or task["cancelled"]:
+            return ret
+
+        # all the sessions are ready, issue all the starts at once
+        to_start = [t for t in targets if not "start_time" in t.keys()]
+        start = time.time()
+        rets = await asyncio.gather(*[self.start_trace(task, t) for t in to_start])
+        ret = self.targets_error(to_start, rets)
+        self.record_phase(task, "start", ret, time.time() - start)
         if ret != 0:
-            task["lock"].acquire()
-            task["status"] = self.THREAD_ERROR
-            task["lock"].release()
             return ret
+        first = min([t["start_time"] for t in targets])
+        for t in targets:
+            t["start_skew"] = t["start_time"] - first
+        return 0
+
+    async def analysis_job(self, task):
+        # second phase: stop the sessions, then transfer and analyse the
+        # trace of each target as soon as its own session is stopped, the
+        # analyses do not hold a worker while they wait for a server, the
+        # last target to complete finishes the job
+        task["stop_start"] = time.time()
+        if task["mode"] != "live":
+            task["pending"] = len(task["targets"])
+        try:
+            self.set_status(task, self.JOB_ANALYSING)
+        finally:
+            # stop_target always completes the target
+            await asyncio.gather(*[self.stop_target(task, t) for t in task["targets"]])
+
+    async def stop_target(self, task, target):
+        try:
+            ret = await self.stop_trace(task, target)
+        except Exception as e:
+            ret = "Session stop error: %s\n" % e, 503
+        task["stop_end"] = time.time()
+        if ret != 0:
+            target["stop_ret"] = ret
+        try:
+            self.release_target(task, target)
+        finally:
+            if ret == 0 and task["mode"] == "trace" and not task["cancelled"]:
+                self.dispatch_analysis(task, target)
+            else:
+                # the end of the session ends a live analysis, the snapshots
+                # were recorded on demand
+                self.target_done(task, target)
+
+    async def record_snapshot(self, task, target, snapshot):
+        try:
+            await self.sshpool.run_async(target["username"], target["host"],
+                    "lttng snapshot record -s %s" % task["session_name"],
+                    target["sshport"])
+            ret = "ok"
+        except subprocess.CalledProcessError:
+            ret = "Snapshot record error"
+        task["lock"].acquire()
+        snapshot["hosts"][target["host"]] = ret
+        task["lock"].release()
 
+    async def record_snapshots(self, task):
+        # write the content of the ring buffers of all the targets to the
+        # relay
+        task["lock"].acquire()
+        snapshot = {}
+        snapshot["id"] = len(task["snapshots"]) + 1
+        snapshot["time"] = time.time()
+        snapshot["hosts"] = {}
+        task["snapshots"].append(snapshot)
+        task["lock"].release()
+        await asyncio.gather(*[self.record_snapshot(task, t, snapshot)
+            for t in task["targets"]])
+        return snapshot
+
+    def take_snapshot(self, jobid):
+        self.jobs_lock.acquire()
+        task = self.jobs.get(jobid)
+        self.jobs_lock.release()
+        if task is None:
+            return "Unknown or completed job ID %d\n" % jobid, 503
+        if task["mode"] != "snapshot":
+            return "Job %d is not a snapshot job\n" % jobid, 400
+        if task["status"] != self.JOB_TRACING:
+            return "Job %d is not tracing\n" % jobid, 503
+        snapshot = self.engine.run(self.record_snapshots(task))
         task["lock"].acquire()
-        task["status"] = self.THREAD_COMPLETE
+        ret = json.dumps(snapshot)
         task["lock"].release()
+        self.update_job(task)
+        return Response(ret, mimetype="application/json")
+
+    def cancel_job(self, jobid):
+        self.jobs_lock.acquire()
+        task = self.jobs.get(jobid)
+        self.jobs_lock.release()
+        if task is None:
+            return "Unknown or completed job ID %d\n" % jobid, 503
+        if task["cancelled"]:
+            return "Job %d is already being cancelled\n" % jobid
+        task["cancelled"] = True
+        if self.admission.cancel(jobid):
+            # still waiting for the admission, nothing started
+            self.finish_job(task, 0)
+            return "Job %d cancelled\n" % jobid
+        self.engine.loop.call_soon_threadsafe(self.cancel_running, task)
+        return "Cancelling job %d\n" % jobid
+
+    def cancel_running(self, task):
+        # on the loop: kill the remote commands in progress, a failed setup
+        # destroys the sessions, and a tracing job is stopped right away,
+        # without analysis
+        for proc in list(task["procs"]):
+            self.sshpool.kill(proc)
+        self.engine.expire(task)
+
+    def dispatch_analysis(self, task, target):
+        if not "analysis_start" in task.keys():
+            task["analysis_start"] = time.time()
+        try:
+            self.analysis_scheduler.submit((task, target),
+                    "analysis" in target.keys())
+        except Exception as e:
+            target["analysis_ret"] = "Analysis dispatch error: %s\n" % e, 503
+            self.target_done(task, target)
+
+    def target_done(self, task, target):
+        task["pending"] -= 1
+        if task["pending"] > 0:
+            # progress of the job, one host is done
+            self.update_job(task)
+            return
+        ret = "Job completion error\n", 503
+        try:
+            targets = task["targets"]
+            stop_rets = [t.get("stop_ret", 0) for t in targets]
+            analysis_rets = [t.get("analysis_ret", 0) for t in targets]
+            self.record_phase(task, "stop", self.first_error(stop_rets),
+                    task["stop_end"] - task["stop_start"])
+            if len([t for t in targets if "analysis_ret" in t.keys()]) > 0:
+                self.record_phase(task, "analysis", self.first_error(analysis_rets),
+                        time.time() - task["analysis_start"])
+            rets = []
+            for (s, a) in zip(stop_rets, analysis_rets):
+                if s != 0:
+                    rets.append(s)
+                else:
+                    rets.append(a)
+            ret = self.targets_error(targets, rets)
+        finally:
+            self.finish_job(task, ret)
+
+    def first_error(self, rets):
+        for r in rets:
+            if r != 0:
+                return r
         return 0
 
-    def launch_analysis(self, host, username, hostname, session_name, type, mongohost,
-            mongoport):
+    async def run_analysis(self, item, server):
+        # run the analysis of a target on the server chosen by the scheduler,
+        # or on the host in the request, or on the relay
+        (task, target) = item
+        if task["cancelled"]:
+            self.target_done(task, target)
+            return
+        if server is not None:
+            target["analysis"] = self.analyses_servers.analysis_address(server)
+            username = server["sshuser"]
+            port = server["sshport"]
+        else:
+            if not "analysis" in target.keys():
+                target["analysis"] = target["relay_host"]
+            username = target["username"]
+            port = self.default_sshport
+        try:
+            ret = 0
+            if task["mode"] == "live":
+                start = time.time()
+                ret = await self.live_analysis(task, target, username, port)
+                self.observe(task["type"], target, "analysis", time.time() - start, ret)
+            # the trace is on the relay
+            elif target["analysis"] != target["relay_host"]:
+                ret = await self.ship_trace(task, target, username, port)
+            if ret == 0 and task["mode"] != "live":
+                await self.trace_size(task, target, username, port)
+                start = time.time()
+                ret = await self.launch_analysis(target["analysis"], username,
+                        target["hostname"], task["session_name"], task["type"],
+                        task["mongohost"], task["mongoport"], port, task["procs"])
+                self.observe(task["type"], target, "analysis", time.time() - start, ret)
+        except Exception as e:
+            ret = "Analysis error: %s\n" % e, 503
+        target["analysis_ret"] = ret
+        self.target_done(task, target)
+
+    async def live_analysis(self, task, target, username, port):
+        # read the events from the relay while the session runs, the output
+        # lines are published on the job as they come, the analysis ends
+        # with the session
+        type = task["type"]
+        relay = target["relay_host"]
+        if ":" in relay:
+            relay = "[%s]" % relay
+        cmd = "python3 %s%s %s %s:%s net://%s/host/%s/%s" % (self.PATH_ANALYSES,
+                self.analyses[type]["script"], self.analyses[type]["args"],
+                task["mongohost"], task["mongoport"], relay, target["hostname"],
+                task["session_name"])
+        proc = await self.sshpool.open_async(username, target["analysis"],
+                shlex.quote(cmd), port, stdout=subprocess.PIPE)
+        task["procs"].add(proc)
+        task["lock"].acquire()
+        target["output"] = collections.deque(maxlen=self.max_output_lines)
+        task["lock"].release()
+        try:
+            await asyncio.wait_for(self.read_output(task, target, proc),
+                    task["duration"] + self.analysis_timeout)
+        except asyncio.TimeoutError:
+            self.sshpool.kill(proc)
+            await proc.wait()
+        finally:
+            task["procs"].discard(proc)
+        if proc.returncode != 0:
+            return "Analysis python script error\n", 503
+        return 0
+
+    async def read_output(self, task, target, proc):
+        async for line in proc.stdout:
+            task["lock"].acquire()
+            target["output"].append(str(line, encoding='utf8').rstrip())
+            target["output_updated"] = time.time()
+            task["lock"].release()
+            self.output_changed(task)
+        await proc.wait()
+
+    def output_changed(self, task):
+        # one update for the lines of all the targets in the interval
+        if task.get("output_flush") is None:
+            task["output_flush"] = self.engine.loop.call_later(
+                    self.output_interval, self.flush_output, task)
+
+    def flush_output(self, task):
+        task["output_flush"] = None
+        if not "finished" in task.keys():
+            self.update_job(task)
+
+    async def ship_trace(self, task, target, username, port):
+        # stream the trace from the relay to the analysis server through the
+        # controller, compressed on the relay and uncompressed on arrival,
+        # without any temporary copy
+        path = "%s/%s*" % (target["hostname"], task["session_name"])
+        start = time.time()
+        src = await self.sshpool.open_async(target["relay_user"], target["relay_host"],
+                shlex.quote("cd %s && tar -I 'gzip -1' -cf - %s" % (self.PATH_TRACES, path)),
+                target["relay_port"], stdout=subprocess.PIPE)
+        dst = await self.sshpool.open_async(username, target["analysis"],
+                shlex.quote("mkdir -p %s && tar -C %s -xzf -" % (self.PATH_TRACES,
+                    self.PATH_TRACES)),
+                port, stdin=subprocess.PIPE)
+        task["procs"].update([src, dst])
+        nbytes = 0
+        try:
+            nbytes = await asyncio.wait_for(self.pump_trace(src, dst),
+                    self.analysis_timeout)
+        except asyncio.TimeoutError:
+            self.sshpool.kill(src)
+            self.sshpool.kill(dst)
+            await src.wait()
+            await dst.wait()
+        finally:
+            task["procs"].difference_update([src, dst])
+        elapsed = time.time() - start
+        if src.returncode != 0 or dst.returncode != 0:
+            self.observe(task["type"], target, "transfer", elapsed, 1)
+            return "Trace transfer error\n", 503
+        self.observe(task["type"], target, "transfer", elapsed)
+        target["transfer_bytes"] = nbytes
+        target["transfer_seconds"] = round(elapsed, 3)
+        if elapsed > 0:
+            target["transfer_throughput"] = int(nbytes / elapsed)
+        return 0
+
+    async def pump_trace(self, src, dst):
+        # returns the number of bytes transferred
+        nbytes = 0
+        try:
+            while True:
+                chunk = await src.stdout.read(256 * 1024)
+                if not chunk:
+                    break
+                nbytes += len(chunk)
+                dst.stdin.write(chunk)
+                await dst.stdin.drain()
+            dst.stdin.close()
+        except (BrokenPipeError, ConnectionResetError):
+            # the receiving end failed, reported by the caller
+            if src.returncode is None:
+                self.sshpool.kill(src)
+        await src.wait()
+        await dst.wait()
+        return nbytes
+
+    async def trace_size(self, task, target, username, port):
+        # the volume of the trace received by the relay, for the placement
+        # of the next sessions, not fatal
+        try:
+            ret = await self.sshpool.run_async(username, target["analysis"],
+                    shlex.quote("du -sbc %s%s/%s* | tail -1" % (self.PATH_TRACES,
+                        target["hostname"], task["session_name"])), port,
+                    procs=task["procs"])
+            target["trace_bytes"] = int(str(ret, encoding='utf8').split()[0])
+        except (subprocess.CalledProcessError, ValueError, IndexError):
+            return
+        if "relay_id" in target.keys():
+            self.relay_balancer.record(target["relay_id"], target["trace_bytes"])
+
+    async def launch_analysis(self, host, username, hostname, session_name, type, mongohost,
+            mongoport, port=22, procs=None):
         if not "script" in self.analyses[type].keys() or \
                 not "args" in self.analyses[type].keys():
                     return "Missing analyses script or args\n", 503
         script = self.analyses[type]["script"]
         args = self.analyses[type]["args"]
         try:
-            ret = subprocess.check_output("%s %s@%s python3 %s%s %s %s:%s %s/%s/%s*/kernel" \
-                    % (self.ssh, username, host, self.PATH_ANALYSES, script, args,
-                        mongohost, mongoport, self.PATH_TRACES, hostname, session_name),
-                    shell=True)
+            ret = await self.sshpool.run_async(username, host,
+                    "python3 %s%s %s %s:%s %s/%s/%s*/kernel" \
+                    % (self.PATH_ANALYSES, script, args, mongohost, mongoport,
+                        self.PATH_TRACES, hostname, session_name), port,
+                    timeout=self.analysis_timeout, procs=procs)
         except subprocess.CalledProcessError:
             return "Analysis python script error\n", 503
         return 0
 
-    def cleanup_threads(self):
-        # get rid of the completed threads
-        # FIXME: only called from get_analyses_list for now, need a GC
-        to_delete = []
-        for s in self.running_threads.keys():
-            t =  self.running_threads[s]
-            t["lock"].acquire()
-            if t["status"] == self.THREAD_COMPLETE or \
-                    t["status"] == self.THREAD_ERROR:
-                t["thread"].join()
-                to_delete.append(s)
-            t["lock"].release()
-
-        for d in to_delete:
-            del self.running_threads[d]
+    def job_summary(self, task):
+        sess = {}
+        sess["jobid"] = task["jobid"]
+        sess["type"] = task["type"]
+        sess["mode"] = task["mode"]
+        sess["channel"] = task["channel"]
+        sess["created"] = task["created"]
+        task["lock"].acquire()
+        sess["status"] = task["status"]
+        if "error" in task.keys():
+            sess["error"] = task["error"]
+        sess["phases"] = dict(task["phases"])
+        if task["snapshots"]:
+            sess["snapshots"] = [dict(sn, hosts=dict(sn["hosts"])) for sn in task["snapshots"]]
+        outputs = {}
+        for t in task["targets"]:
+            if "output" in t.keys():
+                outputs[t["host"]] = (list(t["output"]), t.get("output_updated"))
+        task["lock"].release()
+        if "finished" in task.keys():
+            sess["finished"] = task["finished"]
+        sess["hosts"] = []
+        for target in task["targets"]:
+            h = {}
+            h["host"] = target["host"]
+            for k in ["hostname", "relay", "analysis", "start_skew", "trace_bytes",
+                    "transfer_bytes", "transfer_seconds", "transfer_throughput", "error"]:
+                if k in target.keys():
+                    h[k] = target[k]
+            if "timings" in target.keys():
+                h["timings"] = dict(target["timings"])
+            # the last lines of a live analysis
+            if target["host"] in outputs.keys():
+                (h["output"], h["output_updated"]) = outputs[target["host"]]
+            sess["hosts"].append(h)
+        return sess
+
+    def get_job(self, jobid):
+        self.jobs_lock.acquire()
+        if jobid in self.jobs.keys():
+            task = self.jobs[jobid]
+            self.jobs_lock.release()
+            return jsonify(self.job_summary(task))
+        if jobid in self.history.keys():
+            self.history.move_to_end(jobid)
+            sess = self.history[jobid]
+            self.jobs_lock.release()
+            return jsonify(sess)
+        self.jobs_lock.release()
+        sess = self.jobstore.get(jobid)
+        if sess is None:
+            return "Unknown job ID %d\n" % jobid, 503
+        return jsonify(sess)
 
     def get_analyses_list(self):
-        self.cleanup_threads()
-        sessions = []
-        for s in self.running_threads.keys():
-            sess = {}
-            t =  self.running_threads[s]
-            sess["jobid"] = t["jobid"]
-            t["lock"].acquire()
-            sess["status"] = t["status"]
-            t["lock"].release()
-            sessions.append(sess)
-        return jsonify( { 'sessions': sessions } )
+        # optional filters, the jobs are listed from the most recent, up to
+        # "limit" jobs, the next page starts "before" the last job ID listed
+        filters = {}
+        for f in ["status", "host", "type"]:
+            if f in request.args:
+                filters[f] = request.args[f]
+        try:
+            for f in ["since"]:
+                if f in request.args:
+                    filters[f] = float(request.args[f])
+            for f in ["before", "limit"]:
+                if f in request.args:
+                    filters[f] = int(request.args[f])
+            if "limit" in filters.keys() and filters["limit"] < 1:
+                raise ValueError
+        except ValueError:
+            return "Invalid filter value\n", 400
+        if not "limit" in filters.keys() or filters["limit"] > self.max_list_limit:
+            filters["limit"] = self.max_list_limit
+
+        # the events after this cursor are the changes since the listing,
+        # including the updates of the jobs not written yet
+        cursor = self.events.cursor()
+        unwritten = self.jobstore.unwritten_since()
+        if unwritten is not None and unwritten < cursor:
+            cursor = unwritten
+        sessions = self.jobstore.list(**filters)
+        ret = {}
+        ret["sessions"] = sessions
+        ret["cursor"] = cursor
+        if len(sessions) == filters["limit"]:
+            ret["next"] = sessions[-1]["jobid"]
+        ret["engine"] = self.engine.stats()
+        ret["relays"] = self.relay_balancer.stats()
+        ret["analyses_servers"] = self.analysis_scheduler.stats()
+        ret["admission"] = self.admission.stats()
+        return jsonify(ret)
+
+    def request_targets(self):
+        # the hosts to trace: "host", a list of "hosts" or a client "group"
+        if 'sshport' in request.json:
+            sshport = request.json["sshport"]
+            if self.invalid_int(request.json, {"sshport": self.PORT_RANGE}):
+                return "Invalid sshport, expecting a port number\n", 400
+        else:
+            sshport = self.default_sshport
+        if 'username' in request.json and \
+                (not isinstance(request.json["username"], str) or \
+                not request.json["username"]):
+            return "Invalid username\n", 400
+
+        targets = []
+        if 'group' in request.json:
+            clients = self.client.get_group_clients(request.json["group"])
+            if not clients:
+                return "Unknown or empty client group %s\n" % request.json["group"], 503
+            for c in clients:
+                t = {}
+                if c["ipv4"]:
+                    t["host"] = c["ipv4"]
+                elif c["ipv6"]:
+                    t["host"] = c["ipv6"]
+                else:
+                    t["host"] = c["hostname"]
+                # the username in the request overrides the registered one
+                if 'username' in request.json:
+                    t["username"] = request.json["username"]
+                else:
+                    t["username"] = c["sshuser"]
+                t["sshport"] = c["sshport"]
+                targets.append(t)
+            return targets
+
+        if not 'username' in request.json:
+            abort(400)
+        if 'hosts' in request.json:
+            hosts = request.json["hosts"]
+            if not isinstance(hosts, list) or not hosts or \
+                    not all([isinstance(h, str) and h for h in hosts]):
+                return "Invalid hosts, expecting a list of host names\n", 400
+        elif 'host' in request.json:
+            hosts = [request.json["host"]]
+            if not isinstance(hosts[0], str) or not hosts[0]:
+                return "Invalid host, expecting a host name\n", 400
+        else:
+            abort(400)
+        for h in hosts:
+            # one session per host
+            if h in [t["host"] for t in targets]:
+                continue
+            t = {}
+            t["host"] = h
+            t["username"] = request.json["username"]
+            t["sshport"] = sshport
+            targets.append(t)
+        if not targets:
+            abort(400)
+        return targets
+
+    def assign_relays(self, targets, mode):
+        # the relay of each target: the one in the request, or the least
+        # loaded of the registered relays, or the default relay, a snapshot
+        # session does not use the relay until a snapshot is recorded
+        relay_host = None
+        if 'relay' in request.json:
+            relay_host = request.json["relay"]
+        else:
+            relays = self.relay.get_relays()
+            if not relays:
+                relay_host = self.default_relay
+        if relay_host is not None:
+            for t in targets:
+                t["relay"] = relay_host
+                t["relay_host"] = relay_host
+                t["relay_user"] = t["username"]
+                t["relay_port"] = self.default_sshport
+        else:
+            reserve = mode != "snapshot"
+            chosen = self.relay_balancer.acquire(relays, len(targets), reserve)
+            if chosen is None:
+                return "All the relays are at capacity\n", 429, \
+                        {"Retry-After": "%d" % self.admission_retry}
+            for (t, r) in zip(targets, chosen):
+                if reserve:
+                    t["relay_id"] = r["id"]
+                    t["relay_reserved"] = True
+                t["relay"] = self.relay.relay_url(r)
+                t["relay_host"] = self.relay.relay_address(r)
+                t["relay_user"] = r["sshuser"]
+                t["relay_port"] = r["sshport"]
+
+        # override the analysis server in the request, by default the
+        # scheduler chooses one of the registered analysis servers, or the
+        # relay of the target
+        if 'analysis' in request.json:
+            for t in targets:
+                t["analysis"] = request.json["analysis"]
+        return 0
+
+    def admission_keys(self, mode, target):
+        # the sessions of a target, a snapshot session only streams to the
+        # relay when a snapshot is recorded
+        keys = [("host", target["host"]), ("all", "")]
+        if mode != "snapshot":
+            keys.append(("relay", target["relay_host"]))
+        return keys
+
+    def job_rejected(self, over, retry):
+        self.metrics.inc("tracevisor_admission_rejected_total", {})
+        reasons = []
+        for (kind, name) in over:
+            if kind == "host":
+                reasons.append("host %s is already traced" % name)
+            elif kind == "relay":
+                reasons.append("relay %s is at capacity" % name)
+            else:
+                reasons.append("too many tracing sessions")
+        return "Job rejected: %s\n" % ", ".join(reasons), 429, \
+                {"Retry-After": "%d" % retry}
+
+    def check_admission(self, targets, mode):
+        # early rejection, before any remote command and job ID, the
+        # sessions are only taken by admit_job
+        keys = []
+        for t in targets:
+            keys += self.admission_keys(mode, t)
+        (over, retry) = self.admission.check(keys, self.admission_retry)
+        if over:
+            return self.job_rejected(over, retry)
+        return 0
+
+    def admit_job(self, task, queue):
+        keys = []
+        for t in task["targets"]:
+            keys += self.admission_keys(task["mode"], t)
+        item = None
+        if queue:
+            item = task
+        (status, retry, over) = self.admission.admit(task["jobid"], keys,
+                task["duration"], item, self.admission_retry)
+        if status == "admitted":
+            for t in task["targets"]:
+                t["admitted"] = True
+        elif status == "rejected":
+            return self.job_rejected(over, retry)
+        return status
+
+    def start_admitted(self, tasks):
+        # queued jobs admitted with the sessions released
+        for task in tasks:
+            for t in task["targets"]:
+                t["admitted"] = True
+            self.engine.submit(task, self.setup_job)
+
+    def release_relays(self, targets):
+        for t in targets:
+            if t.pop("relay_reserved", False):
+                self.relay_balancer.release(t["relay_id"])
+
+    def release_target(self, task, target):
+        # the session of the target is over, or never started
+        self.release_relays([target])
+        if target.pop("admitted", False):
+            self.start_admitted(self.admission.release(task["jobid"],
+                self.admission_keys(task["mode"], target)))
 
     def start_analysis(self):
-        params = ['type', 'duration', 'host', 'username']
+        params = ['type', 'duration']
         if not request.json:
             abort(400)
         # mandatory parameters
@@ -342,19 +1720,6 @@ class Tracevisor:
             if not p in request.json:
                 abort(400)
 
-        # override the relay in the request
-        if 'relay' in request.json:
-            r = request.json["relay"]
-        else:
-            r = self.default_relay
-
-        # override the analysis server in the request
-        # by default, take the same address as the relay
-        if 'analysis' in request.json:
-            a = request.json["analysis"]
-        else:
-            a = r
-
         if 'mongohost' in request.json:
             mongohost = request.json["mongohost"]
         else:
@@ -367,32 +1732,102 @@ class Tracevisor:
 
         type = request.json["type"]
         duration = request.json["duration"]
-        host = request.json["host"]
-        username = request.json["username"]
+        if isinstance(duration, bool) or not isinstance(duration, (int, float)) \
+                or duration <= 0:
+            return "Invalid duration, expecting a positive number of seconds\n", 400
 
         if not type in self.analyses.keys():
             return "Unknown analysis type\n", 503
 
-        ret = self.check_requirements(host, username)
+        # "trace" records the whole window then analyses it, "live" analyses
+        # the events while they are recorded, "snapshot" keeps the events in
+        # memory and records them only on demand
+        if 'mode' in request.json:
+            mode = request.json["mode"]
+        else:
+            mode = "trace"
+        if not mode in ["trace", "live", "snapshot"]:
+            return "Unknown mode %s\n" % mode, 400
+        if mode == "live" and not "script" in self.analyses[type].keys():
+            return "The %s analysis has no live mode\n" % type, 400
+
+        channel = self.channel_config(type)
+        if channel is None:
+            return "Invalid channel settings, expecting %s\n" % \
+                    ", ".join(sorted(self.CHANNEL_OPTIONS.keys())), 400
+
+        targets = self.request_targets()
+        if isinstance(targets, tuple):
+            return targets
+
+        ret = self.assign_relays(targets, mode)
+        if ret != 0:
+            return ret
+
+        # a job over the limits is rejected before the preflight, unless it
+        # can wait in the queue
+        if not request.json.get("queue", False):
+            ret = self.check_admission(targets, mode)
+            if ret != 0:
+                self.release_relays(targets)
+                return ret
+
+        ret = "Preflight error\n", 503
+        try:
+            ret = self.engine.run(self.preflight_targets(targets, type))
+        finally:
+            if ret != 0:
+                self.release_relays(targets)
         if ret != 0:
             return ret
 
-        self.jobid += 1
+        created = time.time()
+        jobid = self.jobstore.create(type, self.JOB_QUEUED,
+                [t["host"] for t in targets],
+                {"mode": mode, "channel": channel, "created": created})
         task = {}
-        task["status"] = self.THREAD_STARTED
+        task["status"] = self.JOB_QUEUED
         task["lock"] = threading.Lock()
-        task["relay"] = r
-        task["analysis"] = a
+        task["phases"] = {}
+        task["targets"] = targets
+        task["type"] = type
+        task["mode"] = mode
+        task["snapshots"] = []
+        # the running remote commands of the job, killed if it is cancelled
+        task["procs"] = set()
+        task["cancelled"] = False
+        task["channel"] = channel
+        task["duration"] = duration
         task["mongohost"] = mongohost
         task["mongoport"] = mongoport
-        task["jobid"] = self.jobid
-        t = threading.Thread(name='trace', target=self.launch_trace,
-                args=(host, username, r, type, duration, task))
-        task["thread"] = t
-        self.running_threads[self.jobid] = task
-        t.start()
-        return "Started %s analysis for %d seconds on host %s, jobid = %d\n" % \
-                (type, duration, host, self.jobid)
+        task["jobid"] = jobid
+        task["created"] = created
+        task["session_name"] = "%s-%s-%s-%s" % (appname, type,
+                str(int(time.time())), jobid)
+        self.jobs_lock.acquire()
+        self.jobs[jobid] = task
+        self.jobs_lock.release()
+        # once registered, a queued job may be admitted at any time
+        status = self.admit_job(task, request.json.get("queue", False))
+        if isinstance(status, tuple):
+            self.jobs_lock.acquire()
+            del self.jobs[jobid]
+            self.jobs_lock.release()
+            self.jobstore.delete(jobid)
+            for t in targets:
+                self.release_target(task, t)
+            return status
+        self.update_job(task)
+        hosts = ", ".join([t["host"] for t in targets])
+        if status == "queued":
+            return "Queued %s analysis for %d seconds on %s, jobid = %d\n" % \
+                    (type, duration, hosts, jobid)
+        self.engine.submit(task, self.setup_job)
+        if len(targets) == 1:
+            return "Started %s analysis for %d seconds on host %s, jobid = %d\n" % \
+                    (type, duration, hosts, jobid)
+        return "Started %s analysis for %d seconds on hosts %s, jobid = %d\n" % \
+                (type, duration, hosts, jobid)
 
 app = Flask(__name__)
 appname = "Tracevisor"
@@ -413,11 +1848,40 @@ def get_analyses():
 def get_ssh_keys():
     return tracevisor.get_ssh_keys()
 
+@app.route('/trace/api/v1.0/sshpool', methods = ['GET'])
+@crossdomain(origin='*')
+def get_sshpool_stats():
+    return tracevisor.get_sshpool_stats()
+
+@app.route('/trace/api/v1.0/events', methods = ['GET'])
+@crossdomain(origin='*')
+def get_events():
+    return tracevisor.get_events()
+
+@app.route('/metrics', methods = ['GET'])
+def get_metrics():
+    return tracevisor.get_metrics()
+
 @app.route('/trace/api/v1.0/list', methods = ['GET'])
 @crossdomain(origin='*')
 def get_analyses_list():
     return tracevisor.get_analyses_list()
 
+@app.route('/trace/api/v1.0/jobs/<int:jobid>', methods = ['GET'])
+@crossdomain(origin='*')
+def get_job(jobid):
+    return tracevisor.get_job(jobid)
+
+@app.route('/trace/api/v1.0/jobs/<int:jobid>', methods = ['DELETE', 'OPTIONS'])
+@crossdomain(origin='*', headers=['Content-Type'])
+def cancel_job(jobid):
+    return tracevisor.cancel_job(jobid)
+
+@app.route('/trace/api/v1.0/jobs/<int:jobid>/snapshot', methods = ['POST', 'OPTIONS'])
+@crossdomain(origin='*', headers=['Content-Type'])
+def take_snapshot(jobid):
+    return tracevisor.take_snapshot(jobid)
+
 @app.route('/trace/api/v1.0/analyses', methods = ['POST', 'OPTIONS'])
 @crossdomain(origin='*', headers=['Content-Type'])
 def start_analysis():
@@ -429,6 +1893,16 @@ def start_analysis():
 def get_relays_list():
     return tracevisor.relay.get_relays_list()
 
+@app.route('/trace/api/v1.0/relays/bulk', methods = ['POST', 'OPTIONS'])
+@crossdomain(origin='*', headers=['Content-Type'])
+def bulk_relays():
+    return tracevisor.relay.bulk_relays()
+
+@app.route('/trace/api/v1.0/relays/export', methods = ['GET'])
+@crossdomain(origin='*')
+def export_relays():
+    return tracevisor.relay.export_relays()
+
 @app.route('/trace/api/v1.0/relays/<int:relay_id>', methods = ['GET'])
 @crossdomain(origin='*')
 def get_relay(relay_id):
@@ -455,6 +1929,16 @@ def delete_relay(relay_id):
 def get_server_list():
     return tracevisor.get_server_list()
 
+@app.route('/trace/api/v1.0/clients/bulk', methods = ['POST', 'OPTIONS'])
+@crossdomain(origin='*', headers=['Content-Type'])
+def bulk_clients():
+    return tracevisor.client.bulk_clients()
+
+@app.route('/trace/api/v1.0/clients/export', methods = ['GET'])
+@crossdomain(origin='*')
+def export_clients():
+    return tracevisor.client.export_clients()
+
 @app.route('/trace/api/v1.0/clients/<int:client_id>', methods = ['GET'])
 @crossdomain(origin='*')
 def get_client(client_id):
@@ -481,6 +1965,16 @@ def delete_client(client_id):
 def get_analysis_list():
     return tracevisor.analyses_servers.get_analysis_list()
 
+@app.route('/trace/api/v1.0/analyses_servers/bulk', methods = ['POST', 'OPTIONS'])
+@crossdomain(origin='*', headers=['Content-Type'])
+def bulk_analyses():
+    return tracevisor.analyses_servers.bulk_analyses()
+
+@app.route('/trace/api/v1.0/analyses_servers/export', methods = ['GET'])
+@crossdomain(origin='*')
+def export_analyses():
+    return tracevisor.analyses_servers.export_analyses()
+
 @app.route('/trace/api/v1.0/analyses_servers/<int:analyses_id>', methods = ['GET'])
 @crossdomain(origin='*')
 def get_analysis(analyses_id):
@@ -504,4 +1998,5 @@ def delete_analyses(analyses_id):
 if __name__ == '__main__':
     tracevisor = Tracevisor()
     tracevisor.check_db()
+    tracevisor.jobstore.recover()
     app.run(host='0.0.0.0', debug = True)